@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Benchmark: the notebook's per-item parsers vs. `normalize`.
+
+Usage:
+
+    ./bench_normalize.py [items_count] [items_file]
+
+Without an items file, a synthetic instamart-like file is generated.
+"""
+# pylint: disable=fixme
+
+import re
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+import pandas as pd
+
+import normalize
+
+
+# The notebook's implementation, kept as-is for comparison.
+
+def legacy_read_jsl(fobj):
+    for line in fobj:
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        yield item
+
+
+def legacy_parse_number(value):
+    if len(value) > 100:
+        return None
+    value = value.replace(',', '.').replace(' ', '').strip()
+    if not re.search(r'^-?[0-9]+(?:\.[0-9]+)?$', value):
+        return None
+    return float(value)
+
+
+def legacy_parse_price(item):
+    value = item.get('price_text')
+    if not value:
+        return None
+    if not value.endswith(' ₽'):
+        return None
+    return legacy_parse_number(value[:-2])
+
+
+LEGACY_AMOUNT_MAP = {' кг': 1000, ' г': 1}
+
+
+def legacy_parse_mass(value):
+    if not value:
+        return None
+    for key, multiplier in LEGACY_AMOUNT_MAP.items():
+        if value.endswith(key):
+            value = legacy_parse_number(value[:-len(key)])
+            if not value:
+                continue
+            value = value * multiplier
+            return value
+    return None
+
+
+def legacy_parse_cals(item):
+    value = item['nutrition_properties'].get('Калорийность')
+    suffix = ' ккал'
+    if not value or not value.endswith(suffix):
+        return None
+    return legacy_parse_number(value[:-len(suffix)])
+
+
+def legacy_load(filename):
+    with open(filename) as fobj:
+        data = legacy_read_jsl(fobj)
+        data = (dict(
+            item,
+            nutrition_properties=item.get('nutrition_properties') or item.get('nutritipn_properties') or {},
+        ) for item in data)
+        data = (dict(
+            url=item['url'],
+            title=item['title'],
+            cat=item['crumbs'][-1]['title'],
+            amount_text=item.get('amount_text'),
+            price_text=item.get('price_text'),
+            protein_text=item['nutrition_properties'].get('Белки'),
+            carbs_text=item['nutrition_properties'].get('Углеводы'),
+            cals_text=item['nutrition_properties'].get('Калорийность'),
+            nutrition_title=item.get('nutrition_title'),
+            price_rub=legacy_parse_price(item),
+            protein_g=legacy_parse_mass(item['nutrition_properties'].get('Белки')),
+            carbs_g=legacy_parse_mass(item['nutrition_properties'].get('Углеводы')),
+            cals=legacy_parse_cals(item),
+            amount_g=legacy_parse_mass(item.get('amount_text')),
+        ) for item in data)
+        data = list(data)
+    df = pd.DataFrame(data)
+    df = df.copy()
+    df['rub_per_protein_g'] = df['price_rub'] / (df['protein_g'] / 100 * df['amount_g'])
+    df = df.copy()
+    df['cals_per_protein_g'] = df['cals'] / df['protein_g']
+    df['q'] = df['rub_per_protein_g'] * df['cals']
+    df['rub_per_kg'] = df['price_rub'] / df['amount_g'] * 1000
+    return df
+
+
+def synthetic_item(idx):
+    rnd = random.Random(idx)
+
+    def num(low, high):
+        return '{:.1f}'.format(rnd.uniform(low, high)).replace('.', rnd.choice('.,'))
+
+    nutrition = {
+        'Белки': '{} г'.format(num(0, 30)),
+        'Углеводы': '{} г'.format(num(0, 60)),
+        'Калорийность': '{} ккал'.format(num(10, 600)),
+    }
+    if rnd.random() < 0.1:
+        nutrition.pop('Белки')
+    return dict(
+        url='https://instamart.ru/lenta/products/{}'.format(idx),
+        ts='2018-09-20T00:00:00',
+        crumbs=[dict(url='https://instamart.ru/lenta/c', title='Категория {}'.format(idx % 50))],
+        title='Товар {}'.format(idx),
+        amount_text=rnd.choice(['{} г'.format(rnd.randint(50, 900)), '{} кг'.format(num(1, 5)), '1 шт.']),
+        price_text='{} ₽'.format(num(10, 2000)),
+        nutrition_title='Пищевая ценность на 100 г',
+        nutrition_properties=nutrition,
+    )
+
+
+def write_synthetic(filename, count):
+    with open(filename, 'w') as fobj:
+        for idx in range(count):
+            fobj.write(json.dumps(synthetic_item(idx)) + '\n')
+
+
+def timed(func, *args, **kwargs):
+    start = time.monotonic()
+    result = func(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    filename = sys.argv[2] if len(sys.argv) > 2 else None
+    tmp_dir = None
+    if filename is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmp_dir.name, 'im_bench_items.jsl')
+        write_synthetic(filename, count)
+
+    df_legacy, time_legacy = timed(legacy_load, filename)
+    df_new, time_new = timed(normalize.load_file, filename)
+
+    columns = ('price_rub', 'protein_g', 'carbs_g', 'cals', 'amount_g', 'rub_per_protein_g', 'q')
+    mismatches = {
+        column: int((~(
+            (df_legacy[column].astype(float) - df_new[column]).abs().lt(1e-9) |
+            (df_legacy[column].isna() & df_new[column].isna()))).sum())
+        for column in columns}
+
+    print("Items:      {}".format(len(df_new)))
+    print("Notebook:   {:.3f}s".format(time_legacy))
+    print("normalize:  {:.3f}s".format(time_new))
+    print("Speedup:    {:.2f}x".format(time_legacy / time_new if time_new else float('inf')))
+    print("Mismatches: {}".format(mismatches))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
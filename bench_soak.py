@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Soak benchmark: a long simulated instamart-like crawl against a local mock
+server, sampling the RSS, to check that the memory stays flat.
+
+Usage:
+
+    ./bench_soak.py [items_count] [concurrency] [report.json] [soft_limit_mb]
+
+Defaults to 1M items (takes a while); e.g. `./bench_soak.py 20000 4` for a
+quick check. The mock server runs in a separate process, the items are
+written into a temporary directory. The only state expected to grow is the
+processed URLs set (`WorkerBase.processed_items`), so its estimated size is
+reported alongside. With `report.json`, writes the `run_report` of the
+crawl, to be compared with `./run_report.py compare` against a baseline
+(`-` to skip). With `soft_limit_mb` (e.g. below the peak RSS of a run
+without it), the `memguard` throttling stats are printed too.
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+import http.server
+import multiprocessing
+
+import run_report
+from memguard import rss_bytes, MB
+from scraper_im import WorkerImBase
+
+
+PER_PAGE = 50
+PAGES_PER_CAT = 20
+
+
+def product_html(idx):
+    return '''<html><body><div class="product-popup">
+<div class="product-popup__breadcrumbs"><a class="product-popup__breadcrumbs-link" href="/c/{cat}">Категория {cat}</a></div>
+<h1 class="product-popup__title">Товар {idx}</h1>
+<div class="product-popup__volume">{amount} г</div>
+<div class="product-popup__price">{price} ₽</div>
+<img class="product-popup__img" src="/img/{idx}.jpg" data-zoom="/img/{idx}_zoom.jpg">
+<div class="product-popup__description"><p>Описание товара {idx}. {filler}</p></div>
+<div class="nutrition"><div class="nutrition-title">Пищевая ценность на 100 г</div>
+<div class="product-property"><div class="product-property__name">Белки</div><div class="product-property__value">{protein} г</div></div>
+<div class="product-property"><div class="product-property__name">Калорийность</div><div class="product-property__value">{cals} ккал</div></div>
+</div>
+<div class="other-properties"><div class="product-property"><div class="product-property__name">Бренд</div>
+<div class="product-property__value"><a class="product-link" href="/brands/{brand}">Бренд {brand}</a></div></div></div>
+</div></body></html>'''.format(
+        idx=idx, cat=idx // (PER_PAGE * PAGES_PER_CAT), amount=100 + idx % 900, price=10 + idx % 500,
+        protein=idx % 30, cals=idx % 600, brand=idx % 100, filler='Текст. ' * 50)
+
+
+def listing_html(cat, page, items_count):
+    start = (cat * PAGES_PER_CAT + page - 1) * PER_PAGE
+    if page > PAGES_PER_CAT or start >= items_count:
+        return '<html><body><div class="products_with_filters_wrapper"><div class="empty-filter-message">Пусто</div></div></body></html>'
+    links = ''.join(
+        '<li class="product"><a class="product__link" href="/p/{}">Товар</a></li>'.format(idx)
+        for idx in range(start, min(start + PER_PAGE, items_count)))
+    return '<html><body><div class="products_with_filters_wrapper"><ul>{}</ul></div></body></html>'.format(links)
+
+
+def serve(port, items_count):
+    cats_count = (items_count + PER_PAGE * PAGES_PER_CAT - 1) // (PER_PAGE * PAGES_PER_CAT)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            parts = self.path.strip('/').split('/')
+            if parts == ['root']:
+                body = ''.join(
+                    '<a class="taxon-title__link" href="/c/{}">Категория {}</a>'.format(cat, cat)
+                    for cat in range(cats_count))
+            elif parts[0] == 'c' and len(parts) == 2:
+                body = ''  # a product listing (no subcategories).
+            elif parts[0] == 'c' and len(parts) == 4:
+                body = listing_html(int(parts[1]), int(parts[3]), items_count)
+            elif parts[0] == 'p':
+                body = product_html(int(parts[1]))
+            else:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+class WorkerSoak(WorkerImBase):
+
+    def __init__(self, root_url, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.url_cats = root_url
+        self.cats_file = os.path.join(directory, 'im_soak_categories.json')
+        self.items_file = os.path.join(directory, 'im_soak_items.jsl')
+
+
+def processed_set_bytes(items):
+    """ Rough size of the processed URLs set (the set table and the strings) """
+    if not items:
+        return 0
+    sample = next(iter(items))
+    return sys.getsizeof(items) + len(items) * sys.getsizeof(sample)
+
+
+def main():
+    items_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    report_file = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    soft_limit_mb = float(sys.argv[4]) if len(sys.argv) > 4 else None
+    port = 18000 + os.getpid() % 1000
+    logging.basicConfig(level=logging.WARNING)
+
+    server = multiprocessing.Process(target=serve, args=(port, items_count), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    samples = []  # (seconds, items, rss, processed set bytes)
+    with tempfile.TemporaryDirectory() as directory:
+        worker = WorkerSoak('http://127.0.0.1:{}/root'.format(port), directory)
+        worker.concurrency = concurrency
+        worker.checkpoint_every = 0
+        worker.streaming = True
+        worker.memory_soft_limit_mb = soft_limit_mb
+        stop = threading.Event()
+        start = time.monotonic()
+        started = time.time()
+
+        def sample_loop():
+            while not stop.wait(1.0):
+                items = worker.processed_items
+                samples.append((time.monotonic() - start, len(items), rss_bytes(), processed_set_bytes(items)))
+
+        sampler = threading.Thread(target=sample_loop, daemon=True)
+        sampler.start()
+        try:
+            worker.start_memguard()
+            worker.main_i()
+        finally:
+            stop.set()
+            sampler.join()
+            server.terminate()
+        elapsed = time.monotonic() - start
+        if report_file:
+            run_report.write_report(run_report.build_report(worker, started), report_file)
+
+    print("Items: {}, concurrency: {}, {:.0f}s ({:.0f} items/s)".format(
+        len(worker.processed_items), concurrency, elapsed, len(worker.processed_items) / elapsed))
+    print("{:>8} {:>10} {:>9} {:>12} {:>16}".format('seconds', 'items', 'rss, MB', 'set, MB', 'rss - set, MB'))
+    step = max(1, len(samples) // 20)
+    for seconds, items, rss, set_bytes in samples[::step] + samples[-1:]:
+        print("{:>8.0f} {:>10} {:>9.1f} {:>12.1f} {:>16.1f}".format(
+            seconds, items, rss / MB, set_bytes / MB, (rss - set_bytes) / MB))
+    # Growth over the second half (after the warm-up), not counting the processed URLs set.
+    half = samples[len(samples) // 2:]
+    if len(half) >= 2 and half[-1][1] > half[0][1]:
+        growth = ((half[-1][2] - half[-1][3]) - (half[0][2] - half[0][3])) / (half[-1][1] - half[0][1])
+        print("RSS growth besides the processed set, second half: {:.1f} bytes/item".format(growth))
+    print("Memory guard: {}".format(worker.memguard.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Persistent, incrementally updated catalogue of the normalized items, with
+fast filtered / top-k queries.
+
+The catalogue keeps one columnar file per store in its directory
+(`<store>.parquet` with `pyarrow`, a pickle otherwise) holding the
+`normalize` columns plus the derived metrics (`rub_per_protein_g`,
+`cals_per_protein_g`, `q`, `rub_per_kg`), and `state.json` with the byte
+offset up to which each items file has been loaded. `refresh()` only
+decodes the lines appended since (`jsl_loader` with `start=`), so it can be
+called before every query while the workers are writing; a re-crawled item
+replaces the previous version of the same URL.
+
+In memory the items are kept in one frame with a store / category index
+(value -> row positions), so the queries only look at the matching rows.
+
+Usage:
+
+    ./catalogue.py update im_lenta_items.jsl okd_items.jsl
+    ./catalogue.py query --store im_lenta --sort rub_per_protein_g --max cals_per_protein_g=10 -k 20
+    ./catalogue.py serve --port 8000 im_lenta_items.jsl okd_items.jsl
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import json
+import mmap
+import time
+import logging
+import argparse
+import threading
+import urllib.parse
+import http.server
+
+import numpy as np
+import pandas as pd
+
+import normalize
+from jsl_loader import JslLoader
+from price_history import store_from_items_file
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+LOG = logging.getLogger(__name__)
+
+INDEXED_COLUMNS = ('store', 'cat')
+METRIC_COLUMNS = ('rub_per_protein_g', 'cals_per_protein_g', 'q', 'rub_per_kg')
+NUMERIC_COLUMNS = ('price_rub', 'protein_g', 'carbs_g', 'cals', 'amount_g') + METRIC_COLUMNS
+
+
+def complete_lines_end(filename):
+    """ The offset right after the last newline of the file (a line being written is not complete yet) """
+    size = os.path.getsize(filename)
+    if not size:
+        return 0
+    with open(filename, 'rb') as fobj:
+        with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+            return mem.rfind(b'\n') + 1
+
+
+class Catalogue:
+
+    def __init__(self, directory='catalogue'):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.state = {}  # items file -> dict(store, offset, size)
+        self.frames = {}  # store -> DataFrame
+        self.df = None
+        self.index = {}  # column -> {value -> row positions}
+        self.arrays = {}  # numeric column -> numpy array
+        self.load()
+
+    # Storage
+
+    @property
+    def state_file(self):
+        return os.path.join(self.directory, 'state.json')
+
+    def store_file(self, store):
+        return os.path.join(self.directory, '{}.{}'.format(store, 'parquet' if pa is not None else 'pkl'))
+
+    def load(self):
+        try:
+            with open(self.state_file) as fobj:
+                self.state = json.load(fobj)
+        except FileNotFoundError:
+            self.state = {}
+        for store in set(info['store'] for info in self.state.values()):
+            filename = self.store_file(store)
+            if not os.path.exists(filename):
+                # Lost the data (or switched the format): load the files again.
+                self.state = {
+                    key: info for key, info in self.state.items() if info['store'] != store}
+                continue
+            if pa is not None:
+                self.frames[store] = pd.read_parquet(filename)
+            else:
+                self.frames[store] = pd.read_pickle(filename)
+        self.rebuild()
+
+    def save(self, stores):
+        os.makedirs(self.directory, exist_ok=True)
+        for store in stores:
+            filename = self.store_file(store)
+            if pa is not None:
+                self.frames[store].to_parquet(filename + '.tmp', index=False)
+            else:
+                self.frames[store].to_pickle(filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+        with open(self.state_file + '.tmp', 'w') as fobj:
+            json.dump(self.state, fobj, indent=1)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    # Updates
+
+    def update(self, filenames):
+        """ Load the new lines of the items files; -> count of the loaded items """
+        loaded = 0
+        changed = set()
+        with self.lock:
+            for filename in filenames:
+                count, store = self._update_file(filename)
+                if count:
+                    loaded += count
+                    changed.add(store)
+            if changed:
+                self.save(changed)
+                self.rebuild()
+        return loaded
+
+    def refresh(self):
+        """ `update` of all the known items files """
+        return self.update(list(self.state))
+
+    def _update_file(self, filename):
+        info = self.state.get(filename) or dict(store=store_from_items_file(filename), offset=0, size=0)
+        store = info['store']
+        try:
+            size = os.path.getsize(filename)
+        except FileNotFoundError:
+            return 0, store
+        if size == info['size']:
+            return 0, store
+        frame = self.frames.get(store)
+        if size < info['offset']:
+            LOG.warning("%s got shorter, reloading it", filename)
+            info['offset'] = 0
+            frame = None
+        stop = complete_lines_end(filename)
+        loader = JslLoader(filename, start=info['offset'], stop=stop, workers=1)
+        new_frames = [
+            normalize.normalize_frame(chunk, store)
+            for chunk in loader.batches('pandas') if len(chunk)]
+        info.update(offset=loader.end, size=stop)
+        self.state[filename] = info
+        if not new_frames:
+            return 0, store
+        new_df = normalize.add_metrics(pd.concat(new_frames, ignore_index=True))
+        count = len(new_df)
+        if frame is not None and len(frame):
+            new_df = pd.concat([frame, new_df], ignore_index=True)
+        # A re-crawled item replaces the previous one.
+        self.frames[store] = new_df.drop_duplicates('url', keep='last').reset_index(drop=True)
+        LOG.debug("Catalogue %s: %d new items from %s", store, count, filename)
+        return count, store
+
+    def rebuild(self):
+        frames = [frame for frame in self.frames.values() if len(frame)]
+        if not frames:
+            self.df = pd.DataFrame(columns=list(normalize.COLUMNS) + list(METRIC_COLUMNS))
+        else:
+            self.df = pd.concat(frames, ignore_index=True)
+        self.arrays = {
+            column: self.df[column].to_numpy(dtype=float, na_value=np.nan)
+            for column in NUMERIC_COLUMNS}
+        self.index = {
+            column: {
+                key: np.asarray(positions)
+                for key, positions in self.df.groupby(column, sort=False).indices.items()}
+            for column in INDEXED_COLUMNS}
+
+    # Queries
+
+    def positions(self, **equals):
+        """ store=..., cat=... (a value or a list of values) -> row positions, or None for all the rows """
+        result = None
+        for column, values in equals.items():
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            column_index = self.index[column]
+            found = [column_index[value] for value in values if value in column_index]
+            if not found:
+                positions = np.array([], dtype=np.int64)
+            elif len(found) == 1:
+                positions = found[0]
+            else:
+                # The positions of different values do not overlap.
+                positions = np.sort(np.concatenate(found))
+            result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+        return result
+
+    def query(self, store=None, cat=None, sort=None, k=None, ascending=True, columns=None,
+              min_values=None, max_values=None):
+        """
+        -> DataFrame of the matching items.
+
+        :param min_values, max_values: {column: bound} inclusive filters, e.g. `max_values=dict(cals_per_protein_g=10)`.
+        :param sort: column for the top-k (smallest first unless `ascending=False`); NaN values are skipped.
+        """
+        with self.lock:
+            df = self.df
+            arrays = self.arrays
+            positions = self.positions(store=store, cat=cat)
+        if positions is None:
+            positions = np.arange(len(df))
+        # The filtering and the top-k run on the numpy columns; only the result rows are taken from the frame.
+        for bounds, compare in ((min_values, np.greater_equal), (max_values, np.less_equal)):
+            for column, bound in (bounds or {}).items():
+                positions = positions[compare(arrays[column][positions], bound)]  # NaN compares as False.
+        if sort is not None:
+            values = arrays[sort][positions]
+            present = ~np.isnan(values)
+            positions, values = positions[present], values[present]
+            if not ascending:
+                values = -values
+            if k is not None and k < len(positions):
+                top = np.argpartition(values, k)[:k]
+                positions, values = positions[top], values[top]
+            positions = positions[np.argsort(values, kind='stable')]
+        elif k is not None:
+            positions = positions[:k]
+        result = df.iloc[positions]
+        if columns is not None:
+            result = result[list(columns)]
+        return result
+
+
+def parse_bounds(values):
+    """ ['cals_per_protein_g=10'] -> {'cals_per_protein_g': 10.0} """
+    result = {}
+    for value in values or ():
+        column, _, bound = value.partition('=')
+        result[column] = float(bound)
+    return result
+
+
+def query_params(params):
+    """ HTTP query parameters (lists of values) -> `Catalogue.query` arguments """
+    return dict(
+        store=params.get('store'),
+        cat=params.get('cat'),
+        sort=(params.get('sort') or [None])[0],
+        k=int(params['k'][0]) if params.get('k') else 20,
+        ascending=(params.get('order') or ['asc'])[0] != 'desc',
+        min_values=parse_bounds(params.get('min')),
+        max_values=parse_bounds(params.get('max')),
+    )
+
+
+def make_handler(catalogue, refresh_interval=5.0):
+    last_refresh = [0.0]
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        """ GET /query?store=im_lenta&cat=...&sort=rub_per_protein_g&max=cals_per_protein_g=10&k=20 """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            url = urllib.parse.urlparse(self.path)
+            if url.path != '/query':
+                self.send_error(404)
+                return
+            now = time.monotonic()
+            if now - last_refresh[0] > refresh_interval:
+                last_refresh[0] = now
+                catalogue.refresh()
+            start = time.perf_counter()
+            try:
+                result = catalogue.query(**query_params(urllib.parse.parse_qs(url.query)))
+            except (KeyError, ValueError, TypeError) as exc:
+                self.send_error(400, repr(exc))
+                return
+            body = json.dumps(dict(
+                items=json.loads(result.to_json(orient='records', force_ascii=False)),
+                count=len(result),
+                seconds=time.perf_counter() - start,
+            ), ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            LOG.debug(format, *args)
+
+    return QueryHandler
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Normalized items catalogue.")
+    parser.add_argument('--directory', default='catalogue')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    update_parser = subparsers.add_parser('update')
+    update_parser.add_argument('filenames', nargs='*', help="items files (default: the known ones)")
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('--store', action='append')
+    query_parser.add_argument('--cat', action='append')
+    query_parser.add_argument('--sort')
+    query_parser.add_argument('--desc', action='store_true')
+    query_parser.add_argument('--min', action='append', help="column=value")
+    query_parser.add_argument('--max', action='append', help="column=value")
+    query_parser.add_argument('-k', type=int, default=20)
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('filenames', nargs='*', help="items files to add")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    catalogue = Catalogue(args.directory)
+    if args.command == 'update':
+        loaded = catalogue.update(args.filenames) if args.filenames else catalogue.refresh()
+        LOG.info("Loaded %d items; catalogue: %d items", loaded, len(catalogue.df))
+    elif args.command == 'query':
+        start = time.perf_counter()
+        result = catalogue.query(
+            store=args.store, cat=args.cat, sort=args.sort, k=args.k, ascending=not args.desc,
+            min_values=parse_bounds(args.min), max_values=parse_bounds(args.max))
+        pd.set_option('display.width', 200)
+        print(result)
+        LOG.info("Query: %.1fms", (time.perf_counter() - start) * 1000)
+    elif args.command == 'serve':
+        catalogue.update(args.filenames)
+        server = http.server.ThreadingHTTPServer((args.host, args.port), make_handler(catalogue))
+        LOG.info("Serving %d items on http://%s:%d/query", len(catalogue.df), args.host, args.port)
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
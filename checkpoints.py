@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Pagination checkpoints, so that an interrupted category crawl continues
+from the page it stopped at instead of from the first one.
+
+The state of each category (the cursor: page number / listing offset, and
+whatever else the pager needs) is a small JSON file in
+`<prefix>_checkpoints/`, replaced atomically. What grows with the category
+(e.g. the item URLs seen so far) goes into append-only logs next to it, a
+line per page, so a page costs the same I/O on the first page and the
+thousandth. The files are removed once the category is finished.
+"""
+# pylint: disable=fixme
+
+import os
+import json
+import hashlib
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, log=None):
+        """ -> the state file path, or the `log` (name) file path """
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if log is not None:
+            return os.path.join(self.directory, '{}.{}.jsl'.format(name, log))
+        return os.path.join(self.directory, '{}.json'.format(name))
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as fobj:
+                state = json.load(fobj)
+        except FileNotFoundError:
+            return None
+        except ValueError as exc:
+            LOG.error("Bad checkpoint for %s: %r", key, exc)
+            return None
+        if state.get('key') != key:
+            return None
+        return state
+
+    def save(self, key, state):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        with open(path + '.tmp', 'w') as fobj:
+            json.dump(dict(state, key=key), fobj)
+        os.replace(path + '.tmp', path)
+
+    def append(self, key, log, values):
+        """ Append a line (list of values) to the `log` of the key """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(key, log), 'a') as fobj:
+            fobj.write(json.dumps(values) + '\n')
+
+    def read_log(self, key, log):
+        """ -> all the values appended to the `log` of the key """
+        result = []
+        try:
+            fobj = open(self.path(key, log))
+        except FileNotFoundError:
+            return result
+        with fobj:
+            for line in fobj:
+                try:
+                    result.extend(json.loads(line))
+                except ValueError:  # a line cut by a crash
+                    LOG.warning("Bad checkpoint log line for %s/%s", key, log)
+        return result
+
+    def clear(self, key):
+        prefix = os.path.basename(self.path(key))[:-len('.json')]
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.split('.', 1)[0] == prefix:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def keys(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name)) as fobj:
+                result.append(json.load(fobj).get('key'))
+        return result
+
+    def checkpoint(self, key, every=1, resume=True):
+        return Checkpoint(self, key, every=every, resume=resume)
+
+
+class Checkpoint:
+    """
+    The pagination state of one category.
+
+    `state` is a plain dict, `cursor` being the next page to fetch;
+    `update(...)` changes it and writes it out every `every` calls.
+    `append(log, values)` adds to a log right away (before the cursor moves
+    past them; the pages after the saved cursor are re-read on resume).
+    """
+
+    def __init__(self, store, key, every=1, resume=True):
+        self.store = store
+        self.key = key
+        self.every = every
+        self.state = (store.load(key) if resume else None) or {}
+        self.resumed = bool(self.state)
+        if not self.resumed and self.every:
+            store.clear(key)  # the logs of a not resumed run
+        self._updates = 0
+        if self.resumed:
+            LOG.info("Resuming %s from %r", key, self.state.get('cursor'))
+
+    def get(self, name, default=None):
+        return self.state.get(name, default)
+
+    def update(self, **values):
+        self.state.update(values)
+        self._updates += 1
+        if self.every and self._updates % self.every == 0:
+            self.save()
+
+    def save(self):
+        self.store.save(self.key, self.state)
+
+    def append(self, log, values):
+        if self.every and values:
+            self.store.append(self.key, log, values)
+
+    def read_log(self, log):
+        """ -> the logged values of the resumed run """
+        return self.store.read_log(self.key, log) if self.resumed else []
+
+    def done(self):
+        self.store.clear(self.key)
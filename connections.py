@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Connection-level helpers of the fetch layer:
+
+  * `pool_stats(session)`: new connections vs. requests over the session's
+    urllib3 pools (including the per-proxy ones), i.e. how many requests
+    reused a kept-alive connection instead of a new TCP + TLS handshake;
+  * `install_dns_cache(ttl)`: process-wide `socket.getaddrinfo` cache;
+  * `Http2Adapter`: a `requests` transport adapter over `httpx` with
+    HTTP/2 (optional dependency: `pip install httpx[http2]`), so the
+    session API, the hooks and the redirects handling stay the same.
+"""
+# pylint: disable=fixme
+
+import time
+import socket
+import logging
+import threading
+import collections
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _manager_pools(manager):
+    pools = getattr(manager, 'pools', None)
+    if pools is None:
+        return []
+    with pools.lock:
+        return list(pools._container.values())  # pylint: disable=protected-access
+
+
+def pool_stats(session):
+    """
+    -> dict(connections, requests, reused, reuse_ratio, pools, hosts={host: [connections, requests]})
+    over the session's urllib3 pools; `http2`: the `Http2Adapter` requests counts.
+    """
+    stats = collections.Counter()
+    hosts = collections.defaultdict(lambda: [0, 0])
+    http2_stats = collections.Counter()
+    for adapter in set(session.adapters.values()):
+        if isinstance(adapter, Http2Adapter):
+            http2_stats.update(adapter.stats)
+            continue
+        managers = [getattr(adapter, 'poolmanager', None)]
+        managers.extend(getattr(adapter, 'proxy_manager', {}).values())
+        for manager in managers:
+            for pool in _manager_pools(manager):
+                stats['pools'] += 1
+                stats['connections'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+                host_stats = hosts[pool.host]
+                host_stats[0] += pool.num_connections
+                host_stats[1] += pool.num_requests
+    result = dict(stats)
+    result['reused'] = max(0, stats['requests'] - stats['connections'])
+    result['reuse_ratio'] = result['reused'] / stats['requests'] if stats['requests'] else None
+    result['hosts'] = dict(hosts)
+    if http2_stats:
+        result['http2'] = dict(http2_stats)
+    return result
+
+
+class DnsCache:
+    """ `socket.getaddrinfo` results cache, with a TTL """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cache = {}  # args -> (expires, result)
+        self.stats = collections.Counter()
+        self.original = None
+
+    def getaddrinfo(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is not None and cached[0] > now:
+            self.stats['hits'] += 1
+            return cached[1]
+        self.stats['misses'] += 1
+        result = self.original(*args, **kwargs)
+        with self.lock:
+            self.cache[key] = (now + self.ttl, result)
+        return result
+
+    def install(self):
+        if self.original is None:
+            self.original = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if self.original is not None:
+            socket.getaddrinfo = self.original
+            self.original = None
+
+
+_DNS_CACHE = None
+
+
+def install_dns_cache(ttl=300):
+    """ Install the process-wide DNS cache (once); -> the `DnsCache` """
+    global _DNS_CACHE  # pylint: disable=global-statement
+    if _DNS_CACHE is None:
+        _DNS_CACHE = DnsCache(ttl)
+        _DNS_CACHE.install()
+    return _DNS_CACHE
+
+
+def get_dns_cache():
+    return _DNS_CACHE
+
+
+try:
+    import requests.adapters
+except ImportError:  # Only needed for the `Http2Adapter`.
+    requests = None
+
+
+class _HttpxRaw:
+    """
+    `resp.raw` of the `Http2Adapter` responses: the (decoded) `httpx`
+    response body read in chunks, plus the headers in the form the
+    `requests` cookie extraction reads them (`_original_response.msg`).
+    """
+
+    def __init__(self, resp):
+        import email.message
+        self.resp = resp
+        self.msg = email.message.Message()
+        for key, value in resp.headers.multi_items():
+            self.msg[key] = value
+        self._original_response = self
+        self._chunks = None
+        self._buffer = b''
+
+    def stream(self, amt=65536, decode_content=True):  # pylint: disable=unused-argument
+        while True:
+            chunk = self.read(amt)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, amt=None):
+        if self._chunks is None:
+            self._chunks = self.resp.iter_bytes()
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if amt is None:
+            result, self._buffer = self._buffer, b''
+        else:
+            result, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return result
+
+    def release_conn(self):
+        self.resp.close()
+
+    def close(self):
+        self.resp.close()
+
+
+class Http2Adapter(requests.adapters.BaseAdapter if requests is not None else object):
+    """
+    `requests` adapter sending the requests with `httpx` (HTTP/2 where the
+    server supports it, HTTP/1.1 otherwise), one multiplexed connection per
+    host, proxy and TLS settings. Retries are done here (for the connection
+    errors and `status_forcelist`, with the backoff capped at `backoff_max`
+    like urllib3's), not by urllib3. The cookies are left to the session.
+    """
+
+    backoff_max = 120
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, max_connections=30, retries=5, backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504, 521), backoff_max=None):
+        super().__init__()
+        import httpx  # pylint: disable=import-error
+        # `httpx` only needs `h2` once a client is built; fail here, so that the caller falls back to HTTP/1.1.
+        import h2  # noqa  # pylint: disable=import-error,unused-import
+        self.httpx = httpx
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max or self.backoff_max
+        self.status_forcelist = frozenset(status_forcelist)
+        self.lock = threading.Lock()
+        self.clients = {}  # (proxy url, verify, cert) -> httpx.Client
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def ssl_context(verify=True, cert=None):
+        """ `requests`' `verify` (bool or CA bundle path) and `cert` (path or (cert, key)) -> `ssl.SSLContext` """
+        import ssl
+        if verify is False:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif isinstance(verify, str):
+            import os
+            if os.path.isdir(verify):
+                context = ssl.create_default_context(capath=verify)
+            else:
+                context = ssl.create_default_context(cafile=verify)
+        else:
+            try:
+                import certifi
+            except ImportError:
+                context = ssl.create_default_context()
+            else:
+                context = ssl.create_default_context(cafile=certifi.where())
+        if cert:
+            if isinstance(cert, str):
+                context.load_cert_chain(cert)
+            else:
+                context.load_cert_chain(*cert)
+        return context
+
+    def client(self, proxy=None, verify=True, cert=None):
+        import http.cookiejar
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        key = (proxy, verify, cert)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.httpx.Client(
+                    http2=True, proxy=proxy, follow_redirects=False, trust_env=False,
+                    verify=self.ssl_context(verify, cert),
+                    # The session keeps the cookies; a jar that stores none.
+                    cookies=http.cookiejar.CookieJar(http.cookiejar.DefaultCookiePolicy(allowed_domains=[])),
+                    limits=self.httpx.Limits(max_connections=self.max_connections))
+                self.clients[key] = client
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):  # pylint: disable=too-many-arguments
+        from requests.utils import select_proxy
+        from scraper_base import REQUEST_CONTEXT
+        proxy = select_proxy(request.url, proxies) if proxies else None
+        client = self.client(proxy, verify=verify, cert=cert)
+        if isinstance(timeout, tuple):
+            timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+        deadline = getattr(REQUEST_CONTEXT, 'deadline', None)
+        for attempt in range(self.retries + 1):
+            delay = min(self.backoff_max, self.backoff_factor * (2 ** attempt))
+            last = attempt >= self.retries or (deadline is not None and time.monotonic() + delay >= deadline)
+            try:
+                httpx_request = client.build_request(
+                    request.method, request.url, headers=dict(request.headers),
+                    content=request.body, timeout=timeout)
+                # Streamed: the body is read by the caller (e.g. up to `max_body_size`).
+                resp = client.send(httpx_request, stream=True)
+                if not stream and (resp.status_code not in self.status_forcelist or last):
+                    resp.read()
+            except self.httpx.TransportError as exc:
+                if last:
+                    raise requests.exceptions.ConnectionError(exc, request=request)
+            else:
+                if resp.status_code not in self.status_forcelist or last:
+                    break
+                resp.close()
+            self.stats['retries'] += 1
+            REQUEST_CONTEXT.retries = getattr(REQUEST_CONTEXT, 'retries', 0) + 1
+            time.sleep(delay)
+        self.stats['requests'] += 1
+        if resp.http_version == 'HTTP/2':
+            self.stats['http2_requests'] += 1
+        return self.build_response(request, resp, stream=stream)
+
+    @staticmethod
+    def build_response(request, resp, stream=False):
+        from requests.cookies import extract_cookies_to_jar
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+        result = requests.models.Response()
+        result.status_code = resp.status_code
+        result.headers = CaseInsensitiveDict(resp.headers.multi_items())
+        result.encoding = get_encoding_from_headers(result.headers)
+        result.reason = resp.reason_phrase
+        result.url = request.url
+        result.request = request
+        result.raw = _HttpxRaw(resp)
+        # The session (and the redirects handling) extract from `raw` too.
+        extract_cookies_to_jar(result.cookies, request, result.raw)
+        # `httpx` already decoded the content-encoding.
+        result.headers.pop('Content-Encoding', None)
+        if not stream:
+            result._content = resp.content  # pylint: disable=protected-access
+            result._content_consumed = True  # pylint: disable=protected-access
+        return result
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
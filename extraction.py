@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Declarative per-site extraction specs.
+
+A spec is a list of fields (name -> selector, value kind, post-processor,
+default), compiled once (on the first use) into `soupsieve` matchers. Fields sharing a `within`
+scope selector get the scope element looked up once per item.
+
+Instead of logging a traceback per failed field, the failures are counted
+per (spec, field, kind) in `ExtractionStats`, so that site markup changes
+show up as the aggregate rates. The per-item lists the specs can't express
+(e.g. the properties tables) are extracted by the workers with the None-safe
+lookups and counted there, one kind per item: 'ok', 'partial' (some entries
+incomplete) or 'missing'.
+"""
+# pylint: disable=fixme
+
+import urllib.parse
+import threading
+import collections
+
+
+POST_ERRORS = (AttributeError, TypeError, ValueError, IndexError, KeyError)
+
+
+def compile_selector(selector):
+    import soupsieve
+    return soupsieve.compile(selector)
+
+
+def el_text(el):
+    """ Same as `WorkerBase.el_text` for tags """
+    return el.text.replace('\xa0', ' ').strip()
+
+
+class Field:
+
+    def __init__(self, name, selector=None, value='text', post=None, default=None, many=False, url=False, within=None):
+        """
+        :param selector: CSS selector, relative to the scope; `None` for the scope element itself.
+        :param value: 'text', 'html', 'element' or '@<attribute name>'.
+        :param post: post-processor of the (non-None) value.
+        :param many: extract a list of values of all the matching elements.
+        :param url: join the value with the page url.
+        :param within: scope selector (relative to the spec root).
+        """
+        self.name = name
+        self.selector = selector
+        self.value = value
+        self.post = post
+        self.default = default
+        self.many = many
+        self.url = url
+        self.within = within
+        self._matcher = None
+
+    @property
+    def matcher(self):
+        """ Compiled selector (compiled on the first use, to keep the imports light) """
+        if self._matcher is None and self.selector:
+            self._matcher = compile_selector(self.selector)
+        return self._matcher
+
+    def get_value(self, el, base_url):
+        value = self.value
+        if value == 'text':
+            result = el_text(el)
+        elif value == 'html':
+            result = el.decode()
+        elif value == 'element':
+            result = el
+        elif value.startswith('@'):
+            result = el.get(value[1:])
+        else:
+            raise ValueError("Unknown field value kind", value)
+        if result is not None and self.url:
+            result = urllib.parse.urljoin(base_url, result)
+        return result
+
+
+class ExtractionStats:
+    """ Thread-safe counters of the extracted / missing / failed fields """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.Counter()  # spec name -> items count
+        self.counts = collections.Counter()  # (spec name, field name, kind) -> count
+
+    def add(self, spec_name, counts, item=True):
+        """
+        :param counts: {(field name, kind): count}.
+        :param item: count an item; `False` for the fields extracted outside the spec.
+        """
+        with self.lock:
+            if item:
+                self.items[spec_name] += 1
+            for (field_name, kind), count in counts.items():
+                self.counts[(spec_name, field_name, kind)] += count
+
+    def rates(self):
+        """ -> {(spec name, field name, kind): share of the items} """
+        with self.lock:
+            return {
+                key: count / self.items[key[0]]
+                for key, count in self.counts.items()
+                if self.items[key[0]]}
+
+    def log(self, logger):
+        for (spec_name, field_name, kind), rate in sorted(self.rates().items()):
+            if kind == 'ok':
+                continue
+            logger.info(
+                "Extraction %s.%s: %s in %.1f%% of %d items",
+                spec_name, field_name, kind, rate * 100, self.items[spec_name])
+
+
+class ExtractionSpec:
+
+    def __init__(self, name, fields, root=None):
+        """
+        :param root: selector of the item element; the item fails if it is not found.
+        """
+        self.name = name
+        self.fields = list(fields)
+        self.root_selector = root
+        self._root = None
+        self._scopes = None
+
+    @property
+    def scopes(self):
+        if self._scopes is None:
+            self._scopes = {
+                field.within: compile_selector(field.within)
+                for field in self.fields if field.within}
+        return self._scopes
+
+    def find_root(self, item_bs):
+        if self.root_selector is None:
+            return item_bs
+        if self._root is None:
+            self._root = compile_selector(self.root_selector)
+        root = self._root.select_one(item_bs)
+        if root is None:
+            raise ValueError("Extraction root not found", self.name)
+        return root
+
+    def extract(self, item_bs, base_url=None, stats=None, root=None):
+        """
+        parsed page -> {field name: value}
+
+        :param root: already found (with `find_root`) item element.
+        """
+        if root is None:
+            root = self.find_root(item_bs)
+        scopes = {
+            within: matcher.select_one(root)
+            for within, matcher in self.scopes.items()}
+        counts = collections.Counter()
+        result = {}
+        for field in self.fields:
+            scope = scopes[field.within] if field.within else root
+            result[field.name], kind = self._extract_field(field, scope, base_url)
+            counts[(field.name, kind)] += 1
+        if stats is not None:
+            stats.add(self.name, counts)
+        return result
+
+    @staticmethod
+    def _extract_field(field, scope, base_url):
+        """ -> (value, 'ok' | 'missing' | 'failed') """
+        if scope is None:
+            return field.default, 'missing'
+        if field.matcher is None:
+            els = [scope]
+        elif field.many:
+            els = field.matcher.select(scope)
+        else:
+            el = field.matcher.select_one(scope)
+            els = [el] if el is not None else []
+        values = []
+        for el in els:
+            value = field.get_value(el, base_url)
+            if value is not None and field.post is not None:
+                try:
+                    value = field.post(value)
+                except POST_ERRORS:
+                    return field.default, 'failed'
+            values.append(value)
+        if field.many:
+            return values, 'ok' if values else 'missing'
+        if not values or values[0] is None:
+            return field.default, 'missing'
+        return values[0], 'ok'
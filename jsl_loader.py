@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Parallel chunked loader of the JSON-lines (`*.jsl`) files for analysis.
+
+The file is memory-mapped and split into chunks at newline boundaries; the
+chunks are decoded in a process pool (with `orjson` / `ujson` when
+available), optionally keeping only the requested fields, and yielded as
+pandas / arrow batches in the file order.
+
+Undecodable lines are logged and collected in `JslLoader.errors` as
+`(byte offset, error)`; they are never replaced by other items.
+
+Usage:
+
+    ./jsl_loader.py im_lenta_items.jsl [field ...]
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import mmap
+import time
+import logging
+import itertools
+import collections
+import concurrent.futures
+
+try:
+    import orjson as json_lib
+except ImportError:
+    try:
+        import ujson as json_lib
+    except ImportError:
+        import json as json_lib
+
+
+LOG = logging.getLogger(__name__)
+
+
+def chunk_bounds(filename, chunk_size, start=0, stop=None):
+    """ -> [(start, end), ...] byte ranges, each ending right after a newline (or at EOF / `stop`) """
+    size = os.path.getsize(filename)
+    if stop is not None:
+        size = min(size, stop)
+    if size <= start:
+        return []
+    bounds = []
+    with open(filename, 'rb') as fobj:
+        with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+            pos = start
+            while pos < size:
+                end = min(pos + chunk_size, size)
+                if end < size:
+                    newline = mem.find(b'\n', end - 1)
+                    end = size if newline < 0 else newline + 1
+                bounds.append((pos, end))
+                pos = end
+    return bounds
+
+
+def decode_chunk(filename, start, end, fields=None):
+    """ (file, byte range) -> (records, [(offset, error), ...]) """
+    records = []
+    errors = []
+    with open(filename, 'rb') as fobj:
+        with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+            data = mem[start:end]
+    offset = start
+    loads = json_lib.loads
+    for line in data.split(b'\n'):
+        line_offset = offset
+        offset += len(line) + 1
+        if not line.strip():
+            continue
+        try:
+            item = loads(line)
+        except ValueError as exc:
+            errors.append((line_offset, repr(exc)))
+            continue
+        if fields is not None:
+            item = {key: item.get(key) for key in fields}
+        records.append(item)
+    return records, errors
+
+
+class JslLoader:
+
+    chunk_size = 32 * 1024 * 1024
+    max_logged_errors = 20
+
+    def __init__(self, filename, fields=None, workers=None, chunk_size=None, start=0, stop=None):
+        """
+        :param fields: top-level keys to keep (all by default).
+        :param workers: decoding processes count; `1` decodes in this process.
+        :param start: byte offset to start from (for incremental loading).
+        :param stop: byte offset to stop at (e.g. the end of the last complete line).
+        """
+        self.filename = filename
+        self.fields = tuple(fields) if fields is not None else None
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size or self.chunk_size
+        self.start = start
+        self.stop = stop
+        self.end = start  # byte offset up to which the file has been loaded.
+        self.errors = []  # (offset, error)
+
+    def _handle_errors(self, errors):
+        for offset, error in errors:
+            if len(self.errors) < self.max_logged_errors:
+                LOG.error("Bad JSON line at %s:%d: %s", self.filename, offset, error)
+            self.errors.append((offset, error))
+
+    def record_batches(self):
+        """ -> iterable of lists of dicts """
+        bounds = chunk_bounds(self.filename, self.chunk_size, start=self.start, stop=self.stop)
+        start_time = time.monotonic()
+        count = 0
+        if self.workers <= 1 or len(bounds) <= 1:
+            results = (decode_chunk(self.filename, start, end, self.fields) for start, end in bounds)
+            for (_, end), (records, errors) in zip(bounds, results):
+                self._handle_errors(errors)
+                self.end = end
+                count += len(records)
+                yield records
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                # A bounded window of the chunks in flight, so that the decoded
+                # results do not pile up ahead of a slow consumer.
+                window = self.workers * 2
+                pending = collections.deque()
+                to_submit = iter(bounds)
+                for start, end in itertools.islice(to_submit, window):
+                    pending.append((end, pool.submit(decode_chunk, self.filename, start, end, self.fields)))
+                while pending:
+                    end, future = pending.popleft()
+                    records, errors = future.result()
+                    for start, next_end in itertools.islice(to_submit, 1):
+                        pending.append((next_end, pool.submit(decode_chunk, self.filename, start, next_end, self.fields)))
+                    self._handle_errors(errors)
+                    self.end = end
+                    count += len(records)
+                    yield records
+        LOG.debug(
+            "Loaded %s: %d records, %d errors, %.2fs",
+            self.filename, count, len(self.errors), time.monotonic() - start_time)
+
+    def records(self):
+        for batch in self.record_batches():
+            yield from batch
+
+    def batches(self, kind='pandas'):
+        """
+        :param kind: 'pandas' (DataFrames), 'arrow' (`pyarrow.Table`s) or 'records' (lists of dicts).
+        """
+        if kind == 'records':
+            yield from self.record_batches()
+        elif kind == 'pandas':
+            import pandas as pd
+            for batch in self.record_batches():
+                yield pd.DataFrame.from_records(batch, columns=self.fields)
+        elif kind == 'arrow':
+            import pyarrow as pa
+            for batch in self.record_batches():
+                yield pa.Table.from_pylist(batch)
+        else:
+            raise ValueError("Unknown batch kind", kind)
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+    filename = sys.argv[1]
+    fields = sys.argv[2:] or None
+    loader = JslLoader(filename, fields=fields)
+    count = sum(len(batch) for batch in loader.record_batches())
+    print("Records: {}, errors: {}".format(count, len(loader.errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Cross-store product matching.
+
+Takes the `normalize` output of any number of stores and groups the same
+product across the stores into clusters:
+
+  * the titles are normalized (case, 'ё', punctuation, the amount and
+    packaging tokens cut out), the brand is taken from the quotes
+    (`Молоко «Простоквашино» ...`), the amount is taken from the title when
+    the item has none;
+  * each title gets a MinHash signature over its character 3-grams; the
+    signature bands (plus the rounded amount) are the LSH blocking keys,
+    so only the items sharing a bucket are compared, not all the pairs;
+  * the candidate pairs from different stores are verified by the other
+    numbers in the title (e.g. the fat percentage), the brand, the amount
+    and the exact 3-gram Jaccard similarity, and merged with union-find.
+
+Usage:
+
+    ./matching.py im_lenta_items.jsl im_metro_items.jsl okd_items.jsl utk_items.jsl -o clusters.csv
+"""
+# pylint: disable=fixme
+
+import re
+import sys
+import zlib
+import logging
+import argparse
+import collections
+
+import numpy as np
+import pandas as pd
+
+import normalize
+
+
+LOG = logging.getLogger(__name__)
+
+AMOUNT_RE = re.compile(
+    r'(?<![\w.,])(\d+(?:[.,]\d+)?)\s*(кг|г|гр|л|мл|шт)\.?(?!\w)', re.IGNORECASE)
+# Grams per unit; liters are counted as kilograms, pieces are not an amount.
+TITLE_AMOUNT_UNITS = {'кг': 1000, 'г': 1, 'гр': 1, 'л': 1000, 'мл': 1}
+BRAND_RE = re.compile(r'[«"“]([^»"”]{2,40})[»"”]')
+PACKAGE_RE = re.compile(r'(?<!\w)(?:x|х)\s*\d+(?!\w)|\d+\s*(?:x|х)(?!\w)', re.IGNORECASE)
+NONWORD_RE = re.compile(r'[^\w]+')
+SPACES_RE = re.compile(r'\s+')
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+
+def normalize_text(text):
+    text = (text or '').lower().replace('ё', 'е')
+    return SPACES_RE.sub(' ', NONWORD_RE.sub(' ', text)).strip()
+
+
+def normalize_title(title):
+    """ 'Молоко «Домик в деревне» 3,2%, 930 мл' -> 'молоко домик в деревне 3 2' """
+    title = AMOUNT_RE.sub(' ', title or '')
+    title = PACKAGE_RE.sub(' ', title)
+    return normalize_text(title)
+
+
+def title_brand(title):
+    match = BRAND_RE.search(title or '')
+    if not match:
+        return None
+    return normalize_text(match.group(1)) or None
+
+
+def title_amount(title):
+    """ '... 0,9 кг' -> 900.0 (grams), or None """
+    for value, unit in AMOUNT_RE.findall(title or ''):
+        factor = TITLE_AMOUNT_UNITS.get(unit.lower())
+        if factor:
+            return float(value.replace(',', '.')) * factor
+    return None
+
+
+def shingles(text, size=3):
+    text = ' {} '.format(text)
+    return {text[idx:idx + size] for idx in range(max(1, len(text) - size + 1))}
+
+
+def title_numbers(title):
+    """ The numbers other than the amount, e.g. the fat percentage: '... 3,2%, 930 мл' -> {'3.2'} """
+    title = AMOUNT_RE.sub(' ', title or '')
+    return frozenset(value.replace(',', '.') for value in NUMBER_RE.findall(title))
+
+
+def jaccard(set_a, set_b):
+    if not set_a or not set_b:
+        return 0.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
+
+class UnionFind:
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, idx):
+        parent = self.parent
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    def union(self, idx_a, idx_b):
+        root_a, root_b = self.find(idx_a), self.find(idx_b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+class ProductMatcher:
+
+    num_perm = 64
+    bands = 16  # `num_perm / bands` rows per band; ~0.5 Jaccard LSH threshold.
+    threshold = 0.6  # min 3-gram Jaccard similarity of the matched titles.
+    amount_tolerance = 0.05  # relative amount difference still matched.
+    max_bucket = 200  # larger LSH buckets are too generic to be useful.
+    batch_size = 5000
+    prime = (1 << 31) - 1
+    seed = 1
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        assert self.num_perm % self.bands == 0
+        rnd = np.random.RandomState(self.seed)
+        self.perm_a = rnd.randint(1, self.prime, size=self.num_perm, dtype=np.int64)
+        self.perm_b = rnd.randint(0, self.prime, size=self.num_perm, dtype=np.int64)
+        self.stats = collections.Counter()
+
+    def prepare(self, df):
+        """ `normalize` DataFrame -> the matching columns (`match_title`, `brand`, `match_amount_g`) """
+        titles = df['title'].astype(object).where(df['title'].notna(), None)
+        res = pd.DataFrame(dict(
+            store=df['store'].astype(object),
+            url=df['url'].astype(object),
+            title=titles,
+            price_rub=df['price_rub'].astype(float),
+            amount_g=df['amount_g'].astype(float),
+        ), index=df.index)
+        # `object` columns: with the pandas `str` dtype a missing brand would be a (truthy) NaN.
+        res['match_title'] = pd.Series([normalize_title(title) for title in titles], index=df.index, dtype=object)
+        res['brand'] = pd.Series([title_brand(title) for title in titles], index=df.index, dtype=object)
+        res['numbers'] = pd.Series([title_numbers(title) for title in titles], index=df.index, dtype=object)
+        res['match_amount_g'] = res['amount_g'].where(
+            res['amount_g'].notna(),
+            pd.Series([title_amount(title) for title in titles], index=df.index, dtype=float))
+        return res
+
+    def signatures(self, shingle_sets):
+        """ [set of shingles] -> (items, num_perm) MinHash array """
+        result = np.full((len(shingle_sets), self.num_perm), self.prime, dtype=np.int64)
+        for start in range(0, len(shingle_sets), self.batch_size):
+            batch = shingle_sets[start:start + self.batch_size]
+            lengths = np.fromiter((len(item) for item in batch), dtype=np.int64, count=len(batch))
+            nonempty = lengths > 0
+            if not nonempty.any():
+                continue
+            hashes = np.fromiter(
+                (zlib.crc32(shingle.encode('utf-8')) for item in batch for shingle in item),
+                dtype=np.int64, count=int(lengths.sum()))
+            # Below `prime` (2^31 - 1), so that `hash * a + b` stays under 2^62 in int64.
+            hashes %= self.prime
+            # (shingles, num_perm) permuted hashes, then the min per item segment.
+            permuted = (hashes[:, None] * self.perm_a[None, :] + self.perm_b[None, :]) % self.prime
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            mins = np.minimum.reduceat(permuted, offsets[nonempty], axis=0)
+            result[start + np.flatnonzero(nonempty)] = mins
+        return result
+
+    def candidate_buckets(self, signatures, amount_keys):
+        """ LSH buckets -> lists of the items indexes sharing a bucket """
+        rows = self.num_perm // self.bands
+        for band in range(self.bands):
+            band_sig = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+            buckets = collections.defaultdict(list)
+            for idx, (key, amount_key) in enumerate(zip(map(bytes, band_sig), amount_keys)):
+                buckets[(key, amount_key)].append(idx)
+            for members in buckets.values():
+                if len(members) < 2:
+                    continue
+                if len(members) > self.max_bucket:
+                    self.stats['skipped_buckets'] += 1
+                    continue
+                yield members
+
+    def amounts_match(self, amount_a, amount_b):
+        if amount_a != amount_a or amount_b != amount_b:  # NaN: unknown
+            return True
+        return abs(amount_a - amount_b) <= self.amount_tolerance * max(amount_a, amount_b)
+
+    def match(self, df):
+        """
+        `normalize` DataFrame -> the prepared items with a `cluster` column
+        (the same for the items matched as one product).
+        """
+        items = self.prepare(df).reset_index(drop=True)
+        shingle_sets = [shingles(title) if title else set() for title in items['match_title']]
+        signatures = self.signatures(shingle_sets)
+        stores = items['store'].tolist()
+        amounts = items['match_amount_g'].tolist()
+        brands = [brand if isinstance(brand, str) else None for brand in items['brand']]
+        numbers = items['numbers'].tolist()
+        # Amounts rounded to ~5% steps (log scale) for the blocking; the
+        # items with an unknown amount are only matched between themselves.
+        amount_keys = [
+            None if amount != amount or amount <= 0 else int(round(np.log(amount) / 0.05))
+            for amount in amounts]
+
+        union = UnionFind(len(items))
+        for members in self.candidate_buckets(signatures, amount_keys):
+            for pos, idx_a in enumerate(members):
+                for idx_b in members[pos + 1:]:
+                    if stores[idx_a] == stores[idx_b]:
+                        continue
+                    if union.find(idx_a) == union.find(idx_b):
+                        continue
+                    self.stats['candidates'] += 1
+                    # Cheap checks first: '3,2%' vs '2,5%' are different products.
+                    if numbers[idx_a] != numbers[idx_b]:
+                        continue
+                    if brands[idx_a] and brands[idx_b] and brands[idx_a] != brands[idx_b]:
+                        continue
+                    if not self.amounts_match(amounts[idx_a], amounts[idx_b]):
+                        continue
+                    if jaccard(shingle_sets[idx_a], shingle_sets[idx_b]) < self.threshold:
+                        continue
+                    self.stats['matched'] += 1
+                    union.union(idx_a, idx_b)
+        items['cluster'] = [union.find(idx) for idx in range(len(items))]
+        LOG.info("Matching: %d items, %s", len(items), dict(self.stats))
+        return items
+
+
+def cluster_table(items, min_stores=2):
+    """
+    Matched items -> one row per product cluster: the title, the amount,
+    the per-store (lowest) prices, the stores count and the price spread.
+    """
+    prices = items.pivot_table(index='cluster', columns='store', values='price_rub', aggfunc='min')
+    info = items.groupby('cluster').agg(
+        title=('title', 'first'),
+        amount_g=('match_amount_g', 'median'),
+        items=('url', 'count'),
+    )
+    table = info.join(prices)
+    store_columns = list(prices.columns)
+    table['stores'] = table[store_columns].notna().sum(axis=1)
+    table['price_min'] = table[store_columns].min(axis=1)
+    table['price_max'] = table[store_columns].max(axis=1)
+    table['price_spread'] = table['price_max'] / table['price_min']
+    table = table[table['stores'] >= min_stores]
+    return table.sort_values(['stores', 'price_spread'], ascending=False)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Match the products across the stores.")
+    parser.add_argument('filenames', nargs='+', help="`*_items.jsl` files")
+    parser.add_argument('-o', '--output', default='clusters.csv')
+    parser.add_argument('--threshold', type=float, default=ProductMatcher.threshold)
+    parser.add_argument('--min-stores', type=int, default=2)
+    args = parser.parse_args()
+
+    df = normalize.load(args.filenames, metrics=False)
+    items = ProductMatcher(threshold=args.threshold).match(df)
+    table = cluster_table(items, min_stores=args.min_stores)
+    table.to_csv(args.output)
+    LOG.info("Clusters in %d+ stores: %d, written to %s", args.min_stores, len(table), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
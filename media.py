@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Content-addressed background downloader for the product pictures.
+
+Files are stored by the sha256 of their content in a sharded directory
+(`media/ab/cd/abcd...`), so the same picture under several URLs is stored
+once. Each download is recorded in `<prefix>_media.jsl`
+(`{url, sha256, path, size, content_type, item_url, field, ts}` or
+`{url, error, ...}`); that file is also the URL -> hash index for the
+later runs.
+
+The downloader has its own threads, session and rate limit. `submit` never
+blocks: when the queue is full the URL is dropped (and counted) and will be
+picked up by a later run.
+
+As the items are not held back for their pictures, an item gets the hashes
+(`item['media']`, url -> sha256) only of the pictures already stored when it
+is written; the rest are only in the media records. `join_items` (`./media.py
+join`) writes the items with the `media` of all their stored pictures.
+
+Usage:
+
+    ./media.py join utk_items.jsl -o utk_items_media.jsl
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import json
+import time
+import queue
+import hashlib
+import logging
+import datetime
+import argparse
+import threading
+import collections
+
+
+LOG = logging.getLogger(__name__)
+
+
+def media_path(directory, sha256):
+    return os.path.join(directory, sha256[:2], sha256[2:4], sha256)
+
+
+class MediaDownloader:
+
+    workers = 4
+    # Max requests per second (over all the media threads); `None` for no limit.
+    rate_limit = None
+    queue_size = 1000
+    timeout = 60
+    chunk_size = 64 * 1024
+    user_agent = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0'
+
+    def __init__(self, prefix, directory='media', workers=None, rate_limit=None):
+        """
+        :param prefix: the records file prefix, e.g. 'utk' -> 'utk_media.jsl'.
+        """
+        self.directory = directory
+        self.records_file = '{}_media.jsl'.format(prefix)
+        self.workers = workers or self.workers
+        self.rate_limit = rate_limit or self.rate_limit
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.url_hashes = {}  # url -> sha256
+        self.pending = set()  # urls in the queue or being downloaded
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self._rate_next_ts = 0.0
+        self._session = None
+        self._threads = []
+        self.load_records()
+
+    def load_records(self):
+        try:
+            fobj = open(self.records_file)
+        except FileNotFoundError:
+            return
+        with fobj:
+            for line in fobj:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('sha256'):
+                    self.url_hashes[record['url']] = record['sha256']
+        LOG.debug("Known media: %d urls", len(self.url_hashes))
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from urllib3.util.retry import Retry
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+                pool_connections=self.workers, pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = self.user_agent
+            self._session = session
+        return self._session
+
+    def start(self):
+        with self.lock:
+            if self._threads:
+                return
+            for idx in range(self.workers):
+                thread = threading.Thread(target=self._work_loop, name='media-{}'.format(idx), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, url, item_url=None, field=None):
+        """
+        Returns the sha256 if the URL is already stored; otherwise queues the download and returns None.
+        """
+        if not url:
+            return None
+        with self.lock:
+            sha256 = self.url_hashes.get(url)
+            if sha256 is not None:
+                self.stats['known'] += 1
+                return sha256
+            if url in self.pending:
+                self.stats['pending'] += 1
+                return None
+            try:
+                self.queue.put_nowait((url, item_url, field))
+            except queue.Full:
+                self.stats['dropped'] += 1
+                return None
+            self.pending.add(url)
+            self.stats['queued'] += 1
+        if not self._threads:
+            self.start()
+        return None
+
+    def _work_loop(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            url, item_url, field = task
+            try:
+                record = self.download(url)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.warning("Media download failed: %s: %r", url, exc)
+                record = dict(url=url, error=repr(exc))
+                with self.lock:
+                    self.stats['failed'] += 1
+            record.update(item_url=item_url, field=field, ts=datetime.datetime.now().isoformat())
+            with self.lock:
+                self.pending.discard(url)
+                if record.get('sha256'):
+                    self.url_hashes[url] = record['sha256']
+                with open(self.records_file, 'a', 1) as fobj:
+                    fobj.write(json.dumps(record) + '\n')
+            self.queue.task_done()
+
+    def _wait_rate_limit(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self._rate_next_ts - now
+            self._rate_next_ts = max(now, self._rate_next_ts) + 1.0 / self.rate_limit
+        if wait > 0:
+            time.sleep(wait)
+
+    def download(self, url):
+        """ Fetch into a temporary file while hashing, then move into the content-addressed place """
+        if self.rate_limit:
+            self._wait_rate_limit()
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, '.tmp-{}-{}'.format(os.getpid(), threading.get_ident()))
+        hasher = hashlib.sha256()
+        size = 0
+        with self.session.get(url, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get('Content-Type')
+            with open(tmp_path, 'wb') as fobj:
+                for chunk in resp.iter_content(self.chunk_size):
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    fobj.write(chunk)
+        sha256 = hasher.hexdigest()
+        path = media_path(self.directory, sha256)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+            kind = 'duplicate'
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            kind = 'stored'
+        with self.lock:
+            self.stats[kind] += 1
+            self.stats['bytes'] += size
+        return dict(url=url, sha256=sha256, path=path, size=size, content_type=content_type)
+
+    def close(self, wait=True):
+        """ Stop the threads; with `wait`, after finishing the queued downloads """
+        if not self._threads:
+            return
+        if not wait:
+            # Discard the rest of the queue.
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+            except queue.Empty:
+                pass
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        LOG.info("Media (%s): %s", self.records_file, dict(self.stats))
+
+
+def read_url_hashes(records_file):
+    """ media records file -> ({url: sha256}, set of the fields the urls came from) """
+    url_hashes = {}
+    fields = set()
+    with open(records_file) as fobj:
+        for line in fobj:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('sha256'):
+                url_hashes[record['url']] = record['sha256']
+                if record.get('field'):
+                    fields.add(record['field'])
+    return url_hashes, fields
+
+
+def item_media(item, url_hashes, fields):
+    """ item dict -> {picture url: sha256} of its stored pictures """
+    result = dict(item.get('media') or {})
+    for field in fields:
+        urls = item.get(field)
+        if isinstance(urls, str):
+            urls = [urls]
+        for url in urls or ():
+            sha256 = url_hashes.get(url)
+            if sha256 is not None:
+                result[url] = sha256
+    return result
+
+
+def join_items(items_file, output, records_file=None):
+    """
+    Write the items of `items_file` into `output` with `media` of all their
+    stored pictures (by the picture URL, whichever item or run downloaded it);
+    -> (items count, items with media count)
+    """
+    if records_file is None:
+        records_file = '{}_media.jsl'.format(items_file.rsplit('_items', 1)[0])
+    url_hashes, fields = read_url_hashes(records_file)
+    count = with_media = 0
+    with open(items_file) as fobj, open(output + '.tmp', 'w') as out:
+        for line in fobj:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            media = item_media(item, url_hashes, fields)
+            if media:
+                item['media'] = media
+                with_media += 1
+            count += 1
+            out.write(json.dumps(item, ensure_ascii=False) + '\n')
+    os.replace(output + '.tmp', output)
+    return count, with_media
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Product pictures store.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    join_parser = subparsers.add_parser('join', help="write the items with the hashes of their stored pictures")
+    join_parser.add_argument('items_file')
+    join_parser.add_argument('-o', '--output', help="default: `<prefix>_items_media.jsl`")
+    join_parser.add_argument('--records', help="media records file (default: `<prefix>_media.jsl`)")
+    args = parser.parse_args()
+    output = args.output or '{}_items_media.jsl'.format(args.items_file.rsplit('_items', 1)[0])
+    count, with_media = join_items(args.items_file, output, records_file=args.records)
+    LOG.info("%s: %d items, %d with media", output, count, with_media)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Memory budget and backpressure for the long crawls.
+
+`MemoryGuard` tracks the process RSS and the registered queue sizes. The
+producers (the category pagers) call `throttle()` before fetching the next
+listing page; it waits while a queue is over its limit (i.e. the
+consumers lag), or while the RSS is over the soft limit and there still is
+queued / in-flight work to finish, running the garbage collector in
+between (the RSS rarely goes down by itself, so there's no point in
+waiting with nothing in flight). Over the hard limit it also logs the top retainers (by
+`tracemalloc` when tracing, otherwise by the live objects' types).
+"""
+# pylint: disable=fixme
+
+import os
+import gc
+import sys
+import time
+import logging
+import threading
+import collections
+import tracemalloc
+
+
+LOG = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def rss_bytes():
+    """ The current resident set size, or the peak one where the current is not available """
+    try:
+        with open('/proc/self/statm') as fobj:
+            return int(fobj.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def top_retainers(limit=10):
+    """ -> [(description, size or count), ...] """
+    if tracemalloc.is_tracing():
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+        return [(str(stat.traceback), stat.size) for stat in stats]
+    counts = collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+    return counts.most_common(limit)
+
+
+class MemoryGuard:
+
+    check_interval = 1.0  # seconds between the RSS reads.
+    throttle_sleep = 0.5
+    max_throttle = 60  # max seconds of a single `throttle` wait.
+    retainers_interval = 300  # min seconds between the top retainers logs.
+
+    def __init__(self, soft_limit_mb=None, hard_limit_mb=None, trace=False):
+        """
+        :param trace: start `tracemalloc` (costly) for the file:line retainers.
+        """
+        self.soft_limit = soft_limit_mb * MB if soft_limit_mb else None
+        self.hard_limit = hard_limit_mb * MB if hard_limit_mb else None
+        self.lock = threading.Lock()
+        self.queues = {}  # name -> (size function, limit)
+        self.stats = collections.Counter()
+        self.rss = rss_bytes()
+        self.peak_rss = self.rss
+        self._checked_ts = time.monotonic()
+        self._retainers_ts = 0.0
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+    def register_queue(self, name, size_func, limit=None):
+        """
+        Throttle the producers while `size_func()` is over `limit`;
+        `None` limit: only counted as the pending work.
+        """
+        with self.lock:
+            self.queues[name] = (size_func, limit)
+
+    def update(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_ts < self.check_interval:
+            return self.rss
+        self._checked_ts = now
+        self.rss = rss_bytes()
+        self.peak_rss = max(self.peak_rss, self.rss)
+        return self.rss
+
+    def lagging_queues(self):
+        with self.lock:
+            queues = list(self.queues.items())
+        return [name for name, (size_func, limit) in queues if limit is not None and size_func() > limit]
+
+    def pending(self):
+        with self.lock:
+            queues = list(self.queues.values())
+        return sum(size_func() for size_func, _ in queues)
+
+    def pressure(self, force=False):
+        """ -> None, 'soft', 'hard' or 'queue:<name>' """
+        rss = self.update(force=force)
+        if self.hard_limit and rss > self.hard_limit:
+            return 'hard'
+        if self.soft_limit and rss > self.soft_limit:
+            return 'soft'
+        lagging = self.lagging_queues()
+        if lagging:
+            return 'queue:{}'.format(lagging[0])
+        return None
+
+    def throttle(self, where=''):
+        """ Wait while over the limits; -> seconds waited """
+        reason = self.pressure()
+        if reason is None:
+            return 0.0
+        start = time.monotonic()
+        collected = False
+        while reason is not None and time.monotonic() - start < self.max_throttle:
+            self.stats['throttle_' + reason.split(':')[0]] += 1
+            if reason in ('soft', 'hard') and not collected:
+                gc.collect()
+                collected = True
+            if reason == 'hard':
+                self.log_retainers()
+            if reason in ('soft', 'hard') and not self.pending():
+                self.stats['over_limit_idle'] += 1
+                break
+            time.sleep(self.throttle_sleep)
+            reason = self.pressure(force=True)
+        waited = time.monotonic() - start
+        self.stats['throttled_seconds'] += waited
+        if reason in ('soft', 'hard') and not self.pending():
+            LOG.debug("Memory guard: %s, nothing in flight to wait for at %s", reason, where)
+        elif reason is not None:
+            LOG.warning("Memory guard: still %s after %.0fs at %s, going on", reason, waited, where)
+        else:
+            LOG.info("Memory guard: throttled %s for %.1fs", where, waited)
+        return waited
+
+    def log_retainers(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._retainers_ts < self.retainers_interval:
+            return
+        self._retainers_ts = now
+        LOG.warning(
+            "Memory guard: rss=%.0fMB; top retainers:\n%s",
+            self.rss / MB,
+            '\n'.join('  {}: {}'.format(name, size) for name, size in top_retainers()))
+
+    def summary(self):
+        return dict(
+            rss_mb=round(self.update(force=True) / MB, 1),
+            peak_rss_mb=round(self.peak_rss / MB, 1),
+            **self.stats)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Vectorized normalization of the scraped items into a typed DataFrame.
+
+Loads the workers' `*_items.jsl` files and parses the russian number / unit
+strings (' кг', ' г', ' ₽', ' ккал') with pandas string operations instead
+of per-item python calls. With `pyarrow` installed, the file is decoded by
+the arrow JSON reader and the string operations run as arrow compute
+kernels; without it, the file is read in chunks by `jsl_loader`.
+
+Usage:
+
+    ./normalize.py im_lenta_items.jsl okd_items.jsl
+"""
+# pylint: disable=fixme
+
+import sys
+import logging
+
+import pandas as pd
+
+from price_history import store_from_items_file
+from jsl_loader import JslLoader
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = pc = None
+
+
+LOG = logging.getLogger(__name__)
+
+NUMBER_RE = r'-?[0-9]+(?:\.[0-9]+)?'
+AMOUNT_UNITS = {' кг': 1000, ' г': 1}
+PRICE_UNITS = {' ₽': 1, ' руб.': 1}
+CALS_UNITS = {' ккал': 1}
+
+# Where each kind of store keeps the data, as scraped by the workers.
+# nutrition: the dict-valued columns to look the nutrition values in.
+STORE_KINDS = {
+    'im': dict(price_text='price_text', amount_text='amount_text', nutrition=('nutrition_properties', 'nutritipn_properties')),
+    'okd': dict(price_text='price', nutrition=('props',)),
+    'utk': dict(price_rub='price_per_piece', nutrition=('props',)),
+}
+NUTRITION_KEYS = dict(
+    protein_text=('Белки',),
+    carbs_text=('Углеводы',),
+    cals_text=('Калорийность', 'Энергетическая ценность'),
+    amount_text=('Вес', 'Масса нетто', 'Объем'),
+)
+
+COLUMNS = (
+    'store', 'url', 'title', 'cat',
+    'amount_text', 'price_text', 'protein_text', 'carbs_text', 'cals_text', 'nutrition_title',
+    'price_rub', 'protein_g', 'carbs_g', 'cals', 'amount_g',
+)
+
+
+def store_kind(store):
+    """ 'im_lenta' -> 'im' """
+    return store.split('_', 1)[0]
+
+
+def _is_arrow(values, kind=None):
+    dtype = getattr(values, 'dtype', None)
+    if pa is None or not isinstance(dtype, pd.ArrowDtype):
+        return False
+    if kind is None:
+        return True
+    return kind(dtype.pyarrow_dtype)
+
+
+def _as_text(value):
+    return value if isinstance(value, str) else None
+
+
+def _nulls(index):
+    if pa is not None:
+        return pd.Series(None, index=index, dtype=pd.ArrowDtype(pa.string()))
+    return pd.Series(None, index=index, dtype=object)
+
+
+def strings(values):
+    """ any series -> strings series (None for non-strings), arrow-backed where possible """
+    if _is_arrow(values, pa.types.is_string if pa else None):
+        return values
+    if _is_arrow(values) or values.isna().all():
+        return _nulls(values.index)
+    values = values.astype(object).map(_as_text)
+    if pa is not None:
+        return values.astype(pd.ArrowDtype(pa.string()))
+    return values
+
+
+def parse_number(values):
+    """ strings series -> float series (NaN where not a plain number) """
+    values = strings(values)
+    values = values.where(values.str.len() <= 100)
+    values = (
+        values
+        .str.replace(',', '.', regex=False)
+        .str.replace(' ', '', regex=False)
+        .str.strip())
+    values = values.where(values.str.fullmatch(NUMBER_RE).fillna(False).astype(bool))
+    if _is_arrow(values):
+        return values.astype(pd.ArrowDtype(pa.float64())).astype(float)
+    return pd.to_numeric(values, errors='coerce').astype(float)
+
+
+def parse_suffixed(values, units, skip_zero=False):
+    """
+    strings series -> float series, e.g. '1,5 кг' -> 1500.0 with `AMOUNT_UNITS`.
+
+    :param skip_zero: treat zero as missing (as the notebook's `parse_mass` did).
+    """
+    values = strings(values)
+    result = pd.Series(float('nan'), index=values.index)
+    for suffix, multiplier in units.items():
+        mask = values.str.endswith(suffix).fillna(False).astype(bool) & result.isna()
+        if not mask.any():
+            continue
+        parsed = parse_number(values[mask].str.slice(0, -len(suffix)))
+        if skip_zero:
+            parsed = parsed.where(parsed != 0)
+        result[mask] = parsed * multiplier
+    return result
+
+
+def _column(df, name):
+    if name is None or name not in df.columns:
+        return _nulls(df.index)
+    return df[name]
+
+
+def _dict_get(dicts, key):
+    if _is_arrow(dicts, pa.types.is_struct if pa else None):
+        if dicts.dtype.pyarrow_dtype.get_field_index(key) < 0:
+            return _nulls(dicts.index)
+        return dicts.struct.field(key)
+    if _is_arrow(dicts) or not dicts.notna().any():
+        # No dicts at all (e.g. a chunk of the items without the field).
+        return _nulls(dicts.index)
+    return dicts.str.get(key)
+
+
+def _dict_lookup(df, columns, keys):
+    """ First present string value of any of `keys` in any of the dict-valued `columns` """
+    result = _nulls(df.index)
+    for column in columns:
+        dicts = _column(df, column)
+        for key in keys:
+            result = result.where(result.notna(), strings(_dict_get(dicts, key)))
+    return result
+
+
+def _last_crumb_title(crumbs):
+    if _is_arrow(crumbs, pa.types.is_list if pa else None):
+        arr = crumbs.array._pa_array.combine_chunks()  # pylint: disable=protected-access
+        lengths = pc.fill_null(pc.list_value_length(arr), 0)
+        last_idx = pc.if_else(
+            pc.greater(lengths, 0),
+            pc.subtract(arr.offsets[1:], 1),
+            None)
+        titles = pc.take(arr.values.field('title'), last_idx)
+        return pd.Series(titles, index=crumbs.index, dtype=pd.ArrowDtype(titles.type))
+    if not crumbs.notna().any():
+        return _nulls(crumbs.index)
+    return strings(crumbs.str[-1].str.get('title'))
+
+
+def normalize_frame(df, store):
+    """ raw items DataFrame (one store) -> typed DataFrame with `COLUMNS` """
+    kind = STORE_KINDS[store_kind(store)]
+
+    res = pd.DataFrame(dict(
+        store=store,
+        url=strings(_column(df, 'url')),
+        title=strings(_column(df, 'title')),
+        cat=_last_crumb_title(_column(df, 'crumbs')),
+        price_text=strings(_column(df, kind.get('price_text'))),
+        nutrition_title=strings(_column(df, 'nutrition_title')),
+    ), index=df.index)
+
+    for column, keys in NUTRITION_KEYS.items():
+        res[column] = _dict_lookup(df, kind['nutrition'], keys)
+    amount_text = strings(_column(df, kind.get('amount_text')))
+    res['amount_text'] = amount_text.where(amount_text.notna(), res['amount_text'])
+
+    if kind.get('price_rub'):
+        res['price_rub'] = pd.to_numeric(_column(df, kind['price_rub']), errors='coerce').astype(float)
+    else:
+        res['price_rub'] = parse_suffixed(res['price_text'], PRICE_UNITS)
+    res['protein_g'] = parse_suffixed(res['protein_text'], AMOUNT_UNITS, skip_zero=True)
+    res['carbs_g'] = parse_suffixed(res['carbs_text'], AMOUNT_UNITS, skip_zero=True)
+    res['cals'] = parse_suffixed(res['cals_text'], CALS_UNITS)
+    res['amount_g'] = parse_suffixed(res['amount_text'], AMOUNT_UNITS, skip_zero=True)
+    return res[list(COLUMNS)]
+
+
+def add_metrics(df):
+    """ Derived columns of the notebook, in place """
+    df['rub_per_protein_g'] = df['price_rub'] / (df['protein_g'] / 100 * df['amount_g'])
+    df['cals_per_protein_g'] = df['cals'] / df['protein_g']
+    df['q'] = df['rub_per_protein_g'] * df['cals']  # (rub * cals) / protein_g
+    df['rub_per_kg'] = df['price_rub'] / df['amount_g'] * 1000
+    return df
+
+
+def read_jsl_frames(filename, chunk_size=None):
+    """ items file -> iterable of raw DataFrames """
+    if pa is not None:
+        try:
+            yield pd.read_json(filename, lines=True, engine='pyarrow', dtype_backend='pyarrow')
+            return
+        except pa.ArrowInvalid as exc:
+            # E.g. a field changing its type between the items.
+            LOG.warning("Arrow JSON reader failed on %s (%s), using the chunked reader", filename, exc)
+    yield from JslLoader(filename, chunk_size=chunk_size).batches('pandas')
+
+
+def load_file(filename, store=None, chunk_size=None, metrics=True):
+    store = store or store_from_items_file(filename)
+    frames = [
+        normalize_frame(chunk, store)
+        for chunk in read_jsl_frames(filename, chunk_size=chunk_size)]
+    if not frames:
+        df = pd.DataFrame(columns=list(COLUMNS))
+    else:
+        df = pd.concat(frames, ignore_index=True)
+    if metrics:
+        add_metrics(df)
+    LOG.debug("Normalized %s: %d items", filename, len(df))
+    return df
+
+
+def load(filenames, **kwargs):
+    """ items files of any stores -> one typed DataFrame """
+    df = pd.concat(
+        [load_file(filename, **kwargs) for filename in filenames],
+        ignore_index=True)
+    return df
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+    df = load(sys.argv[1:])
+    print(df.describe())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Append-only history of the scraped items with deduplicated snapshots.
+
+Per store, a `{store}_history.jsl` file holds one `base` record per product
+url, followed by records with only the changed (`set`) and removed (`unset`)
+fields per crawl timestamp. Unchanged re-crawls are not stored at all.
+
+A `{store}_history_index.json` file maps each url to the offsets of its
+records, so that the latest snapshot and the price series of a product can
+be read without loading the whole file.
+
+Usage (import existing crawl results):
+
+    ./price_history.py okd_items.jsl im_lenta_items.jsl
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import json
+import logging
+import threading
+import collections
+
+
+LOG = logging.getLogger(__name__)
+
+# Price-ish fields of the workers' items, in order of preference.
+PRICE_FIELDS = ('price', 'price_text', 'price_per_piece', 'price_per_kg')
+
+
+def store_from_items_file(filename):
+    """ 'im_lenta_items.jsl' -> 'im_lenta' """
+    name = os.path.basename(filename)
+    for suffix in ('_items.jsl', '.jsl'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def diff_item(old, new):
+    """ (old, new) -> (changed fields, removed field names) """
+    changes = {
+        key: val for key, val in new.items()
+        if key not in old or old[key] != val}
+    removed = [key for key in old if key not in new]
+    return changes, removed
+
+
+class PriceHistory:
+
+    skip_keys = ('url', 'ts')
+    # Latest snapshots kept in memory; the others are rebuilt from the file by the offsets index.
+    latest_cache_size = 10000
+
+    def __init__(self, store, directory='.'):
+        self.store = store
+        self.filename = os.path.join(directory, '{}_history.jsl'.format(store))
+        self.index_filename = os.path.join(directory, '{}_history_index.json'.format(store))
+        self.lock = threading.Lock()
+        self.offsets = {}  # url -> [offset, ...]
+        self.indexed_size = 0
+        self._latest = collections.OrderedDict()  # url -> (ts, snapshot); LRU cache of `latest`.
+        self.load_index()
+
+    @classmethod
+    def for_items_file(cls, filename, **kwargs):
+        return cls(store_from_items_file(filename), **kwargs)
+
+    # Index
+
+    def load_index(self):
+        try:
+            with open(self.index_filename) as fobj:
+                index = json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        self.offsets = index.get('offsets') or {}
+        self.indexed_size = index.get('size') or 0
+        self._latest.clear()
+        self._update_index()
+
+    def _update_index(self):
+        """ Index the records appended after the last index save (e.g. after a crash) """
+        try:
+            size = os.path.getsize(self.filename)
+        except FileNotFoundError:
+            self.offsets = {}
+            self.indexed_size = 0
+            return
+        if size < self.indexed_size:
+            LOG.warning("History file %s shrunk, reindexing", self.filename)
+            self.offsets = {}
+            self.indexed_size = 0
+        if size == self.indexed_size:
+            return
+        count = 0
+        with open(self.filename, 'rb') as fobj:
+            fobj.seek(self.indexed_size)
+            offset = self.indexed_size
+            for line in fobj:
+                if line.endswith(b'\n'):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        LOG.error("Bad history record at %s:%d", self.filename, offset)
+                    else:
+                        self.offsets.setdefault(record['url'], []).append(offset)
+                        count += 1
+                offset += len(line)
+        self.indexed_size = offset
+        LOG.debug("History %s: indexed %d new records", self.store, count)
+
+    def save_index(self):
+        with self.lock:
+            data = dict(size=self.indexed_size, offsets=self.offsets)
+            tmp_filename = self.index_filename + '.tmp'
+            with open(tmp_filename, 'w') as fobj:
+                json.dump(data, fobj)
+            os.replace(tmp_filename, self.index_filename)
+
+    # Reading
+
+    def _read_records(self, url):
+        offsets = self.offsets.get(url)
+        if not offsets:
+            return
+        with open(self.filename, 'rb') as fobj:
+            for offset in offsets:
+                fobj.seek(offset)
+                yield json.loads(fobj.readline())
+
+    def snapshots(self, url):
+        """ url -> iterable of (ts, full item state) per stored change """
+        state = {}
+        for record in self._read_records(url):
+            if 'base' in record:
+                state = dict(record['base'])
+            else:
+                state = dict(state)
+                state.update(record.get('set') or {})
+                for key in record.get('unset') or ():
+                    state.pop(key, None)
+            yield record['ts'], state
+
+    def latest(self, url):
+        """ url -> (ts, item state) of the last stored change, or None """
+        cached = self._latest.get(url)
+        if cached is not None:
+            self._latest.move_to_end(url)
+            return cached
+        result = None
+        for result in self.snapshots(url):
+            pass
+        if result is not None:
+            self._cache_latest(url, result)
+        return result
+
+    def _cache_latest(self, url, value):
+        self._latest[url] = value
+        self._latest.move_to_end(url)
+        while len(self._latest) > self.latest_cache_size:
+            self._latest.popitem(last=False)
+
+    def series(self, url, field=None):
+        """ url -> [(ts, value), ...] of the field changes (price by default) """
+        result = []
+        prev = object()
+        for ts, state in self.snapshots(url):
+            if field is None:
+                field = next((key for key in PRICE_FIELDS if key in state), None)
+                if field is None:
+                    continue
+            value = state.get(field)
+            if value != prev:
+                result.append((ts, value))
+                prev = value
+        return result
+
+    def urls(self):
+        return list(self.offsets)
+
+    # Writing
+
+    def _append(self, record):
+        data = (json.dumps(record) + '\n').encode('utf-8')
+        with open(self.filename, 'ab') as fobj:
+            offset = fobj.tell()
+            fobj.write(data)
+        self.offsets.setdefault(record['url'], []).append(offset)
+        self.indexed_size = offset + len(data)
+
+    def add(self, item):
+        """
+        Record a crawled item (as written by `WorkerBase.write_item`).
+
+        Returns the stored record, or None if nothing changed.
+        """
+        url = item['url']
+        ts = item.get('ts')
+        data = {key: val for key, val in item.items() if key not in self.skip_keys}
+        # Normalize through JSON so that the comparison matches the stored values.
+        data = json.loads(json.dumps(data))
+        with self.lock:
+            previous = self.latest(url)
+            if previous is None:
+                record = dict(url=url, ts=ts, base=data)
+            else:
+                changes, removed = diff_item(previous[1], data)
+                if not changes and not removed:
+                    return None
+                record = dict(url=url, ts=ts)
+                if changes:
+                    record['set'] = changes
+                if removed:
+                    record['unset'] = removed
+            self._append(record)
+            self._cache_latest(url, (ts, data))
+        return record
+
+    def import_jsl(self, filename):
+        added = 0
+        total = 0
+        with open(filename) as fobj:
+            for line in fobj:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    LOG.error("Bad item line in %s: %.100r", filename, line)
+                    continue
+                total += 1
+                if self.add(item) is not None:
+                    added += 1
+        self.save_index()
+        LOG.info("History %s: %d items, %d stored changes", self.store, total, added)
+        return added
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG)
+    for filename in sys.argv[1:]:
+        PriceHistory.for_items_file(filename).import_jsl(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Opt-in low-overhead profiling of the crawl stages.
+
+Enabled with `SCRAPER_PROFILE=<prefix>` in the environment (`1` means the
+`profile` prefix). The worker wraps its stages (fetch / parse / extract /
+write, category paging) in `WorkerBase.stage(name)`; the profiler keeps
+per-stage call counts and wall time, and a sampling thread records the
+stacks of the threads currently inside a stage.
+
+At exit (or on SIGUSR1) writes:
+
+  * `<prefix>_stages.json`: per-stage count / total / mean seconds and sample counts;
+  * `<prefix>.collapsed`: collapsed stacks (`stage;frame;frame count`),
+    usable with `flamegraph.pl` or speedscope.
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import logging
+import threading
+import contextlib
+import collections
+
+
+LOG = logging.getLogger(__name__)
+
+PROFILE_ENV = 'SCRAPER_PROFILE'
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(
+        os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+def collapse_stack(frame, limit=100):
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StageProfiler:
+
+    interval = 0.01  # seconds between the stack samples.
+
+    def __init__(self, prefix='profile', interval=None):
+        self.prefix = prefix
+        self.interval = interval or self.interval
+        self.lock = threading.Lock()
+        self.thread_stages = {}  # thread ident -> current stage path
+        self.stage_stats = collections.defaultdict(lambda: [0, 0.0])  # stage path -> [count, seconds]
+        self.stage_samples = collections.Counter()  # stage path -> samples
+        self.stacks = collections.Counter()  # collapsed stack -> samples
+        self._stop = threading.Event()
+        self._write_requested = threading.Event()
+        self._sampler = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ident = threading.get_ident()
+        prev = self.thread_stages.get(ident)
+        path = name if prev is None else '{};{}'.format(prev, name)
+        self.thread_stages[ident] = path
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if prev is None:
+                self.thread_stages.pop(ident, None)
+            else:
+                self.thread_stages[ident] = prev
+            with self.lock:
+                stats = self.stage_stats[path]
+                stats[0] += 1
+                stats[1] += elapsed
+
+    def sample(self):
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        own_ident = threading.get_ident()
+        with self.lock:
+            for ident, path in list(self.thread_stages.items()):
+                frame = frames.get(ident)
+                if frame is None or ident == own_ident:
+                    continue
+                self.stage_samples[path] += 1
+                self.stacks['{};{}'.format(path, collapse_stack(frame))] += 1
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if self._write_requested.is_set():
+                self._write_requested.clear()
+                self.write()
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+        self._sampler.start()
+        atexit.register(self.write)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGUSR1'):
+            # Not `write()` in the handler: it runs on the main thread, which
+            # might be holding `self.lock` (in `stage`) at the moment.
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._write_requested.set())
+        LOG.info("Profiling enabled, output prefix %r", self.prefix)
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                path: dict(
+                    count=count,
+                    total=total,
+                    mean=total / count if count else None,
+                    samples=self.stage_samples.get(path, 0),
+                )
+                for path, (count, total) in sorted(self.stage_stats.items())}
+
+    def write(self):
+        stats = self.stats()
+        with self.lock:
+            stacks = list(self.stacks.items())
+        stats_filename = '{}_stages.json'.format(self.prefix)
+        with open(stats_filename + '.tmp', 'w') as fobj:
+            json.dump(stats, fobj, indent=1)
+        os.replace(stats_filename + '.tmp', stats_filename)
+        stacks_filename = '{}.collapsed'.format(self.prefix)
+        with open(stacks_filename + '.tmp', 'w') as fobj:
+            for stack, count in stacks:
+                fobj.write('{} {}\n'.format(stack, count))
+        os.replace(stacks_filename + '.tmp', stacks_filename)
+        LOG.info("Profile written to %s, %s", stats_filename, stacks_filename)
+
+
+_PROFILER = None
+
+
+def get_profiler(prefix=None):
+    """
+    The process-wide profiler if enabled (by `prefix` or `SCRAPER_PROFILE`), otherwise None.
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    if _PROFILER is not None:
+        return _PROFILER
+    prefix = prefix or os.environ.get(PROFILE_ENV)
+    if not prefix:
+        return None
+    if prefix == '1':
+        prefix = 'profile'
+    _PROFILER = StageProfiler(prefix)
+    _PROFILER.start()
+    return _PROFILER
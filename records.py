@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Typed item records with a versioned schema.
+
+The workers' `process_item_url_i` still build dicts; `WorkerBase` turns the
+item into the site's record type (a slotted dataclass: no per-item keys
+dict) right after the extraction, mapping the legacy key names (the
+`nutritipn_properties` typo) and keeping the unknown keys in `extra`; the
+record is what goes on to the media downloader, the Scrapy item pipeline
+and the items file. `RecordStats` counts the missing (`None` / empty) and
+wrongly typed fields per record type, so the schema drift shows up as the
+rates in the crawl log.
+
+The records are written as JSON lines (with `orjson` when available) with
+the `schema_version` key and, as the dicts were, without the unset (`None`)
+schema fields; `to_arrow` makes a table with the schema from the records'
+annotations (the nested values as JSON strings).
+
+Usage:
+
+    ./records.py im_lenta_items.jsl  # the fill / type rates of an items file
+"""
+# pylint: disable=fixme
+
+import sys
+import json
+import typing
+import logging
+import threading
+import dataclasses
+import collections
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+# Old name -> current name, for reading the old items files.
+LEGACY_KEYS = {
+    'nutritipn_properties': 'nutrition_properties',
+}
+
+
+@dataclasses.dataclass(slots=True)
+class ItemRecord:
+    url: str
+    ts: str
+    title: typing.Optional[str] = None
+    crumbs: typing.Optional[list] = None
+    lastmod: typing.Optional[str] = None
+    media: typing.Optional[dict] = None
+    # The keys not in the schema (e.g. the price kinds the parser did not expect).
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    # Fields not counted as missing when empty.
+    optional_fields: typing.ClassVar[tuple] = ('lastmod', 'media', 'extra')
+
+    @classmethod
+    def from_dict(cls, data):
+        """ item dict (as scraped or as loaded) -> record """
+        names = field_names(cls)
+        values = {}
+        extra = {}
+        for key, value in data.items():
+            key = LEGACY_KEYS.get(key, key)
+            if key in names:
+                values[key] = value
+            elif key != 'schema_version':
+                extra[key] = value
+        values.setdefault('url', None)
+        values.setdefault('ts', None)
+        record = cls(**values)
+        if extra:
+            record.extra.update(extra)
+        return record
+
+    def to_dict(self):
+        """ -> the items file dict (the set schema fields, the `extra` keys on the top level) """
+        result = {'schema_version': SCHEMA_VERSION}
+        for name, _, _ in _checks(type(self)):
+            if name != 'extra':
+                value = getattr(self, name)
+                if value is not None:
+                    result[name] = value
+        result.update(self.extra)
+        return result
+
+    def get(self, key, default=None):
+        """ dict-like access to the schema fields and the `extra` keys """
+        if key in field_names(type(self)) and key != 'extra':
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+
+@dataclasses.dataclass(slots=True)
+class OkdItem(ItemRecord):
+    price: typing.Optional[str] = None
+    price_crossed: typing.Optional[str] = None
+    characteristics_html: typing.Optional[str] = None
+    props: typing.Optional[dict] = None
+
+    optional_fields: typing.ClassVar[tuple] = ItemRecord.optional_fields + ('price_crossed', 'characteristics_html')
+
+
+@dataclasses.dataclass(slots=True)
+class UtkItem(ItemRecord):
+    pictures: typing.Optional[list] = None
+    price_per_piece: typing.Optional[float] = None
+    price_per_kg: typing.Optional[float] = None
+    price_per_something: typing.Optional[float] = None
+    props: typing.Optional[dict] = None
+    etc_props_links: typing.Optional[dict] = None
+    etc_descriptions: typing.Optional[list] = None
+    etc_preamble_original: typing.Optional[str] = None
+    etc_rating: typing.Optional[int] = None
+    etc_rating_numvotes: typing.Optional[int] = None
+    etc_variants_something: typing.Optional[str] = None
+    etc_price_check: typing.Optional[str] = None
+    etc_max_purchase: typing.Optional[str] = None
+
+    optional_fields: typing.ClassVar[tuple] = ItemRecord.optional_fields + (
+        'price_per_kg', 'price_per_something', 'etc_rating', 'etc_rating_numvotes',
+        'etc_variants_something', 'etc_max_purchase')
+
+
+@dataclasses.dataclass(slots=True)
+class ImItem(ItemRecord):
+    price_text: typing.Optional[str] = None
+    amount_text: typing.Optional[str] = None
+    nutrition_title: typing.Optional[str] = None
+    nutrition_properties: typing.Optional[dict] = None
+    ingredients_text: typing.Optional[str] = None
+    description: typing.Optional[list] = None
+    properties: typing.Optional[dict] = None
+    properties_links: typing.Optional[dict] = None
+    etc_image: typing.Optional[str] = None
+    etc_image_preview: typing.Optional[str] = None
+
+    optional_fields: typing.ClassVar[tuple] = ItemRecord.optional_fields + ('ingredients_text', 'properties_links')
+
+
+RECORD_TYPES = {'okd': OkdItem, 'utk': UtkItem, 'im': ImItem}
+
+_FIELDS_CACHE = {}
+
+
+def field_names(cls):
+    """ record type -> frozenset of its field names (cached) """
+    result = _FIELDS_CACHE.get(cls)
+    if result is None:
+        result = _FIELDS_CACHE[cls] = frozenset(field.name for field in dataclasses.fields(cls))
+    return result
+
+
+def _value_types(annotation):
+    """ `Optional[float]` -> (float, int) """
+    args = typing.get_args(annotation) or (annotation,)
+    types = tuple(arg for arg in args if arg is not type(None))
+    if float in types:
+        types += (int,)
+    return types
+
+
+_CHECKS_CACHE = {}
+
+
+def _checks(cls):
+    """ record type -> [(field name, value types, counted as missing when empty)] """
+    result = _CHECKS_CACHE.get(cls)
+    if result is None:
+        hints = typing.get_type_hints(cls)
+        result = _CHECKS_CACHE[cls] = [
+            (field.name, _value_types(hints[field.name]), field.name not in cls.optional_fields)
+            for field in dataclasses.fields(cls)]
+    return result
+
+
+def dumps(data):
+    """ record or dict -> JSON line (bytes, with the newline) """
+    if isinstance(data, ItemRecord):
+        data = data.to_dict()
+    if orjson is not None:
+        # Non-string keys (e.g. a `None` property name) as `json` does them.
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+class RecordStats:
+    """ Thread-safe counters of the missing and wrongly typed record fields """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.Counter()  # record type name -> records count
+        self.counts = collections.Counter()  # (record type name, field name, 'filled' / 'missing' / 'bad_type') -> count
+
+    def add(self, record):
+        """ Validate the record; -> list of (field name, problem) """
+        problems = []
+        filled = []
+        for name, types, required in _checks(type(record)):
+            value = getattr(record, name)
+            if value is None or (not value and isinstance(value, (str, list, dict))):
+                if required:
+                    problems.append((name, 'missing'))
+                continue
+            filled.append(name)
+            if not isinstance(value, types):
+                problems.append((name, 'bad_type'))
+        type_name = type(record).__name__
+        with self.lock:
+            self.items[type_name] += 1
+            for name in filled:
+                self.counts[(type_name, name, 'filled')] += 1
+            for name, problem in problems:
+                self.counts[(type_name, name, problem)] += 1
+        return problems
+
+    def rates(self):
+        """ -> {(record type name, field name, problem): share of the records} """
+        with self.lock:
+            return {
+                key: count / self.items[key[0]]
+                for key, count in self.counts.items()
+                if self.items[key[0]]}
+
+    def log(self, logger):
+        for (type_name, name, problem), rate in sorted(self.rates().items()):
+            if problem == 'filled':
+                continue
+            logger.info(
+                "Records %s.%s: %s in %.1f%% of %d items",
+                type_name, name, problem, rate * 100, self.items[type_name])
+
+
+def arrow_schema(cls):
+    """ record type -> `pyarrow` schema (the containers as JSON strings) """
+    import pyarrow as pa
+    scalar_types = {str: pa.string(), float: pa.float64(), int: pa.int64()}
+    hints = typing.get_type_hints(cls)
+    result = [pa.field('schema_version', pa.int32())]
+    for field in dataclasses.fields(cls):
+        types = _value_types(hints[field.name])
+        result.append(pa.field(field.name, scalar_types.get(types[0], pa.string())))
+    return pa.schema(result)
+
+
+def to_arrow(records, cls=None):
+    """ records (of one type) -> `pyarrow.Table` """
+    import pyarrow as pa
+    records = list(records)
+    if cls is None:
+        cls = type(records[0]) if records else ItemRecord
+    schema = arrow_schema(cls)
+    columns = {name: [] for name in schema.names}
+    for record in records:
+        columns['schema_version'].append(SCHEMA_VERSION)
+        for name, types, _ in _checks(cls):
+            value = getattr(record, name)
+            if value is not None and types[0] in (list, dict):
+                value = dumps(value).decode('utf-8').rstrip('\n')
+            columns[name].append(value)
+    return pa.table(columns, schema=schema)
+
+
+def record_type_for(store):
+    """ 'im_lenta' -> `ImItem` """
+    return RECORD_TYPES.get(store.split('_', 1)[0], ItemRecord)
+
+
+def main():
+    from price_history import store_from_items_file
+    logging.basicConfig(level=logging.INFO)
+    for filename in sys.argv[1:]:
+        cls = record_type_for(store_from_items_file(filename))
+        stats = RecordStats()
+        with open(filename, 'rb') as fobj:
+            for line in fobj:
+                if line.strip():
+                    stats.add(cls.from_dict(json.loads(line)))
+        LOG.info("%s: %d %s records", filename, sum(stats.items.values()), cls.__name__)
+        stats.log(LOG)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+urllib3 `Retry` bound to the `WorkerBase.req` deadline.
+"""
+
+import time
+
+from requests.packages.urllib3.util import Retry  # pylint: disable=import-error
+from requests.packages.urllib3.exceptions import MaxRetryError, ResponseError  # pylint: disable=import-error
+
+from scraper_base import REQUEST_CONTEXT
+
+
+class DeadlineRetry(Retry):
+    """ `Retry` that gives up once the current request's deadline has passed """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):  # pylint: disable=arguments-differ
+        REQUEST_CONTEXT.retries = getattr(REQUEST_CONTEXT, 'retries', 0) + 1
+        deadline = getattr(REQUEST_CONTEXT, 'deadline', None)
+        if deadline is not None and time.monotonic() >= deadline:
+            REQUEST_CONTEXT.deadline_exceeded = True
+            raise MaxRetryError(_pool, url, error or ResponseError("request deadline exceeded"))
+        return super().increment(
+            method=method, url=url, response=response, error=error,
+            _pool=_pool, _stacktrace=_stacktrace)
+
+    def get_backoff_time(self):
+        result = super().get_backoff_time()
+        deadline = getattr(REQUEST_CONTEXT, 'deadline', None)
+        if deadline is not None:
+            result = max(0, min(result, deadline - time.monotonic()))
+        return result
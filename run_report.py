@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Machine-readable crawl run reports, and their comparison.
+
+`WorkerBase.main` writes a report per run into `<prefix>_runs/<started>.json`:
+duration, items / second, per-stage timings, HTTP status histogram,
+requests / retries / proxy switches, body bytes, latency percentiles and
+the per-field fill rates (of the extraction specs and of the item records).
+
+`compare` flags the regressions of a report against a baseline one: the
+performance metrics changed by more than `perf_threshold` (relative) in
+the bad direction, and the fill / failure rates changed by more than
+`fill_threshold` (absolute). Works the same for the production runs and
+for the offline benchmarks (`bench_soak.py ... report.json`).
+
+Usage:
+
+    ./run_report.py show okd_runs/20261019T120000.json
+    ./run_report.py compare okd_runs/20261012T120000.json okd_runs/20261019T120000.json
+    ./run_report.py compare okd_runs  # the last two reports in the directory
+
+`compare` exits with 1 when there are regressions.
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+
+
+LOG = logging.getLogger(__name__)
+
+REPORT_VERSION = 1
+
+# Metric path -> the direction that is worse: 1 (higher is worse) or -1.
+# Only the per-item / per-request ones: the raw `duration` grows with the run size.
+PERF_METRICS = {
+    ('items_per_sec',): -1,
+    ('latency', 'request_p50'): 1,
+    ('latency', 'request_p99'): 1,
+    ('latency', 'item_p50'): 1,
+    ('latency', 'item_p99'): 1,
+    ('ratios', 'retries_per_request'): 1,
+    ('ratios', 'errors_per_request'): 1,
+    ('ratios', 'proxy_switches_per_request'): 1,
+    ('ratios', 'bytes_per_item'): 1,
+    ('ratios', 'requests_per_item'): 1,
+}
+# Ignore the changes of the metrics this small (e.g. a few ms latency jitter).
+MIN_VALUES = {
+    ('latency', 'request_p50'): 0.01,
+    ('latency', 'request_p99'): 0.01,
+    ('latency', 'item_p50'): 0.01,
+    ('latency', 'item_p99'): 0.01,
+    ('ratios', 'retries_per_request'): 0.01,
+    ('ratios', 'errors_per_request'): 0.01,
+    ('ratios', 'proxy_switches_per_request'): 0.001,
+}
+
+
+def _ratio(value, total):
+    return value / total if total else None
+
+
+def field_rates(worker):
+    """ -> {'<spec or record type>.<field>': {kind: rate}} """
+    result = {}
+    for (spec_name, field_name, kind), rate in worker.extract_stats.rates().items():
+        result.setdefault('{}.{}'.format(spec_name, field_name), {})[kind] = round(rate, 4)
+    for (type_name, field_name, kind), rate in worker.record_stats.rates().items():
+        result.setdefault('{}.{}'.format(type_name, field_name), {})[kind] = round(rate, 4)
+    return result
+
+
+def build_report(worker, started, finished=None, error=None):
+    """
+    :param started, finished: `time.time()` of the run start / end.
+    -> report dict
+    """
+    finished = finished or time.time()
+    duration = finished - started
+    counts = dict(worker.req_stats)
+    statuses = dict(sorted((str(key), value) for key, value in worker.status_counts.items()))
+    requests_count = counts.get('requests', 0)
+    items = counts.get('items', 0)
+    errors = sum(value for key, value in statuses.items() if not key.startswith(('2', '3')))
+    report = dict(
+        version=REPORT_VERSION,
+        worker=type(worker).__name__,
+        items_file=worker.items_file,
+        started=datetime.datetime.fromtimestamp(started).isoformat(),
+        finished=datetime.datetime.fromtimestamp(finished).isoformat(),
+        duration=round(duration, 3),
+        error=error,
+        items=items,
+        # None for a run with nothing (new) to do, not comparable.
+        items_per_sec=round(items / duration, 3) if items and duration > 0 else None,
+        settings=dict(
+            concurrency=worker.concurrency, streaming=worker.streaming, discovery=worker.discovery,
+            http2=worker.http2, rate_limit=worker.rate_limit),
+        counts=counts,
+        statuses=statuses,
+        ratios=dict(
+            retries_per_request=_ratio(counts.get('retries', 0), requests_count),
+            errors_per_request=_ratio(errors, requests_count),
+            proxy_switches_per_request=_ratio(counts.get('proxy_switches', 0), requests_count),
+            bytes_per_item=_ratio(counts.get('body_bytes', 0), items),
+            requests_per_item=_ratio(requests_count, items),
+        ),
+        latency=dict(
+            request_p50=worker.req_latencies.percentile(50),
+            request_p99=worker.req_latencies.percentile(99),
+            item_p50=worker.item_latencies.percentile(50),
+            item_p99=worker.item_latencies.percentile(99),
+        ),
+        stages=worker.stage_timer.stats(),
+        errors=len(worker._all_errors),  # pylint: disable=protected-access
+        failures=len(worker.failures),
+        fields=field_rates(worker),
+    )
+    if worker.memguard is not None:
+        report['memory'] = worker.memguard.summary()
+    return report
+
+
+def write_report(report, filename):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename + '.tmp', 'w') as fobj:
+        json.dump(report, fobj, indent=1, ensure_ascii=False)
+    os.replace(filename + '.tmp', filename)
+    LOG.info("Run report written to %s", filename)
+    return filename
+
+
+def load_report(filename):
+    with open(filename) as fobj:
+        return json.load(fobj)
+
+
+def latest_reports(directory, count=2):
+    """ -> the last `count` report files in the directory (the names sort by the start time) """
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    return [os.path.join(directory, name) for name in names[-count:]]
+
+
+def _get(report, path):
+    value = report
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(old, new, perf_threshold=0.2, fill_threshold=0.05):
+    """
+    -> list of dict(metric, old, new, change) regressions of `new` against `old`.
+
+    The fill rates ('ok' of the extraction, 'filled' of the records) regress
+    when they drop; the rest of the field rates ('missing', 'failed',
+    'bad_type', ...) when they grow.
+    """
+    regressions = []
+    for path, worse in PERF_METRICS.items():
+        old_value, new_value = _get(old, path), _get(new, path)
+        if old_value is None or new_value is None:
+            continue
+        if max(abs(old_value), abs(new_value)) < MIN_VALUES.get(path, 0):
+            continue
+        if old_value:
+            change = (new_value - old_value) / abs(old_value)
+        else:
+            change = float('inf') if new_value else 0.0
+        if change * worse > perf_threshold:
+            regressions.append(dict(metric='.'.join(path), old=old_value, new=new_value, change=change))
+    old_fields = old.get('fields') or {}
+    for field, new_rates in sorted((new.get('fields') or {}).items()):
+        old_rates = old_fields.get(field)
+        if old_rates is None:
+            continue
+        for kind in sorted(set(old_rates) | set(new_rates)):
+            old_value, new_value = old_rates.get(kind, 0.0), new_rates.get(kind, 0.0)
+            worse = -1 if kind in ('ok', 'filled') else 1
+            change = new_value - old_value
+            if change * worse > fill_threshold:
+                regressions.append(dict(
+                    metric='fields.{}.{}'.format(field, kind), old=old_value, new=new_value, change=change))
+    return regressions
+
+
+def format_regressions(regressions):
+    if not regressions:
+        return "No regressions"
+    return '\n'.join(
+        "{metric}: {old:.4g} -> {new:.4g} ({change:+.1%})".format(**item)
+        for item in regressions)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Crawl run reports.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    show_parser = subparsers.add_parser('show')
+    show_parser.add_argument('report')
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('reports', nargs='+', help="baseline and new report, or a reports directory")
+    compare_parser.add_argument('--perf-threshold', type=float, default=0.2, help="relative change")
+    compare_parser.add_argument('--fill-threshold', type=float, default=0.05, help="absolute rate change")
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        print(json.dumps(load_report(args.report), indent=1, ensure_ascii=False))
+        return 0
+    filenames = args.reports
+    if len(filenames) == 1 and os.path.isdir(filenames[0]):
+        filenames = latest_reports(filenames[0])
+    if len(filenames) != 2:
+        parser.error("need two reports to compare")
+    regressions = compare(
+        load_report(filenames[0]), load_report(filenames[1]),
+        perf_threshold=args.perf_threshold, fill_threshold=args.fill_threshold)
+    print("{} -> {}".format(*filenames))
+    print(format_regressions(regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Command-line entry point for all the workers.
+
+Usage:
+
+    ./scrape.py list
+    ./scrape.py status okd im:lenta
+    ./scrape.py run okd --concurrency 8 --rate-limit 5
+    ./scrape.py run im --force           # all the known instamart stores
+    ./scrape.py run utk --engine scrapy
+    ./scrape.py run im:metro --dry-run
+"""
+# pylint: disable=fixme
+
+import os
+import sys
+import logging
+import argparse
+import importlib
+
+
+LOG = logging.getLogger(__name__)
+
+# name -> 'module:class'; the modules are imported only when needed.
+WORKERS = {
+    'okd': 'scraper_okd:WorkerOkey',
+    'utk': 'scraper_utk:WorkerUtk',
+    'im': 'scraper_im:WorkerImCommon',  # 'im:<store>'; just 'im' for all `known_names`.
+}
+
+
+def get_worker_cls(name):
+    module_name, cls_name = WORKERS[name].split(':')
+    return getattr(importlib.import_module(module_name), cls_name)
+
+
+def make_workers(spec):
+    """ 'okd' / 'im:lenta' / 'im' -> [worker, ...] """
+    name, _, arg = spec.partition(':')
+    if name not in WORKERS:
+        raise argparse.ArgumentTypeError("Unknown worker {!r}; known: {}".format(name, ', '.join(WORKERS)))
+    worker_cls = get_worker_cls(name)
+    if name == 'im':
+        names = [arg] if arg else worker_cls.known_names
+        return [worker_cls(store) for store in names]
+    return [worker_cls()]
+
+
+def worker_label(worker):
+    name = getattr(worker, 'name', None)
+    return '{}:{}'.format(type(worker).__name__, name) if name else type(worker).__name__
+
+
+def count_lines(filename):
+    try:
+        with open(filename, 'rb') as fobj:
+            return sum(1 for _ in fobj)
+    except FileNotFoundError:
+        return None
+
+
+def configure_worker(worker, args):
+    """ Apply the command-line tuning knobs to a worker """
+    settings = dict(
+        force=args.force,
+        concurrency=args.concurrency,
+        rate_limit=args.rate_limit,
+        request_deadline=args.request_deadline,
+        hedge_percentile=args.hedge_percentile,
+        _max_errors=args.max_errors,
+        download_media=args.media,
+        media_workers=args.media_concurrency,
+        media_rate_limit=args.media_rate_limit,
+        checkpoint_every=args.checkpoint_every,
+        http2=args.http2,
+        dns_cache_ttl=args.dns_cache_ttl,
+        pool_maxsize=args.pool_maxsize,
+        streaming=args.streaming,
+        discovery=args.discovery,
+        sitemap_since=args.sitemap_since,
+        memory_soft_limit_mb=args.memory_soft_limit,
+        memory_hard_limit_mb=args.memory_hard_limit,
+        max_body_size=args.max_body_size,
+        run_report_dir=args.run_report_dir,
+    )
+    for key, value in settings.items():
+        if value is not None:
+            setattr(worker, key, value)
+    return settings
+
+
+def cmd_list(args):  # pylint: disable=unused-argument
+    for name, target in WORKERS.items():
+        print('{:<6} {}'.format(name, target))
+    print('im stores: {}'.format(', '.join(get_worker_cls('im').known_names)))
+
+
+def cmd_status(args):
+    for spec in args.workers:
+        for worker in make_workers(spec):
+            files = [worker.items_file] + [
+                getattr(worker, attr) for attr in ('cat_items_file', 'cats_file')
+                if getattr(worker, attr, None)]
+            print(worker_label(worker))
+            for filename in files:
+                lines = count_lines(filename)
+                print('  {:<32} {}'.format(filename, 'missing' if lines is None else '{} lines'.format(lines)))
+            checkpoint_dir = '{}_checkpoints'.format(worker.items_file.rsplit('_items', 1)[0])
+            if os.path.isdir(checkpoint_dir):
+                unfinished = sum(1 for name in os.listdir(checkpoint_dir) if name.endswith('.json'))
+                print('  {:<32} {} unfinished categories'.format(checkpoint_dir, unfinished))
+
+
+def cmd_run(args):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.profile:
+        os.environ['SCRAPER_PROFILE'] = args.profile
+    scrapy_workers = []  # (name, worker)
+    for spec in args.workers:
+        for worker in make_workers(spec):
+            settings = configure_worker(worker, args)
+            if args.format == 'history':
+                from price_history import PriceHistory
+                worker.history = PriceHistory.for_items_file(worker.items_file)
+            if args.dry_run:
+                print("{}: engine={}, items_file={!r}, format={}, {}".format(
+                    worker_label(worker), args.engine, worker.items_file, args.format,
+                    ', '.join('{}={!r}'.format(key, getattr(worker, key)) for key in settings)))
+                continue
+            if args.engine == 'scrapy':
+                scrapy_workers.append((spec.partition(':')[0], worker))
+                continue
+            try:
+                worker.main()
+            finally:
+                if worker.history is not None:
+                    worker.history.save_index()
+    if scrapy_workers:
+        run_scrapy(scrapy_workers, args)
+
+
+# `--engine scrapy`: the options of the requests-based fetching layer (the `args` attribute -> the option).
+SCRAPY_UNSUPPORTED = {
+    'request_deadline': '--request-deadline',
+    'hedge_percentile': '--hedge-percentile',
+    'http2': '--http2',
+    'dns_cache_ttl': '--dns-cache-ttl',
+    'pool_maxsize': '--pool-maxsize',
+    'memory_soft_limit': '--memory-soft-limit',
+    'memory_hard_limit': '--memory-hard-limit',
+    'checkpoint_every': '--checkpoint-every',
+    'discovery': '--discovery',
+    'sitemap_since': '--sitemap-since',
+}
+
+
+def run_scrapy(workers, args):
+    """ Crawl with the configured workers' spiders, in one Scrapy process """
+    import scrapy_engine
+    settings = {}
+    if args.concurrency:
+        settings['CONCURRENT_REQUESTS'] = args.concurrency
+    if args.rate_limit:
+        settings['DOWNLOAD_DELAY'] = 1.0 / args.rate_limit
+    if args.max_body_size:
+        settings['DOWNLOAD_MAXSIZE'] = args.max_body_size
+    try:
+        scrapy_engine.crawl_workers(workers, settings=settings)
+    finally:
+        for _, worker in workers:
+            if worker.history is not None:
+                worker.history.save_index()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Grocery stores scraper.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    list_parser = subparsers.add_parser('list', help="list the known workers")
+    list_parser.set_defaults(func=cmd_list)
+
+    status_parser = subparsers.add_parser('status', help="show the output files state")
+    status_parser.add_argument('workers', nargs='+', help="okd, utk, im, im:<store>")
+    status_parser.set_defaults(func=cmd_status)
+
+    run_parser = subparsers.add_parser('run', help="run the workers")
+    run_parser.add_argument('workers', nargs='+', help="okd, utk, im, im:<store>")
+    run_parser.add_argument('--engine', choices=('requests', 'scrapy'), default='requests')
+    run_parser.add_argument(
+        '--discovery', choices=('html', 'sitemap'),
+        help="find the items by walking the categories (default) or from the sitemaps")
+    run_parser.add_argument('--sitemap-since', help="re-fetch the processed items with a sitemap lastmod at or after this date")
+    run_parser.add_argument('--concurrency', type=int, help="parallel requests (threads running the items, over all the categories)")
+    run_parser.add_argument('--rate-limit', type=float, help="max requests per second")
+    run_parser.add_argument('--request-deadline', type=float, help="seconds per request, including the retries")
+    run_parser.add_argument('--hedge-percentile', type=float, help="hedge GET requests slower than this latency percentile")
+    run_parser.add_argument('--http2', action='store_true', default=None, help="use HTTP/2 where supported (needs `httpx[http2]`)")
+    run_parser.add_argument('--dns-cache-ttl', type=float, help="cache the DNS lookups for this many seconds")
+    run_parser.add_argument('--pool-maxsize', type=int, help="connections per host (default: from the concurrency)")
+    run_parser.add_argument(
+        '--streaming', action='store_true', default=None,
+        help="read the bodies in chunks and parse the bytes with the declared charset")
+    run_parser.add_argument('--max-body-size', type=int, help="max response body size (bytes) when streaming")
+    run_parser.add_argument('--memory-soft-limit', type=float, help="MB of RSS to throttle the category paging at")
+    run_parser.add_argument('--memory-hard-limit', type=float, help="MB of RSS to also log the top retainers at")
+    run_parser.add_argument('--max-errors', type=int, help="recent errors to keep")
+    run_parser.add_argument(
+        '--format', choices=('jsl', 'history'), default='jsl',
+        help="'history' additionally records the items into the price history store")
+    run_parser.add_argument(
+        '--force', action='store_true', default=None,
+        help="re-crawl everything instead of resuming after the already processed items")
+    run_parser.add_argument(
+        '--media', action='store_true', default=None,
+        help="download the product pictures in the background (see `media`)")
+    run_parser.add_argument('--media-concurrency', type=int, help="media download threads")
+    run_parser.add_argument('--media-rate-limit', type=float, help="max media requests per second")
+    run_parser.add_argument(
+        '--checkpoint-every', type=int,
+        help="save the category pagination state every this many pages; 0 to disable")
+    run_parser.add_argument('--run-report-dir', help="where to write the run reports (default: `<prefix>_runs`)")
+    run_parser.add_argument('--profile', help="profiling output prefix (see `profiling`)")
+    run_parser.add_argument('--dry-run', action='store_true', help="only show what would be run")
+    run_parser.add_argument('-v', '--verbose', action='store_true')
+    run_parser.set_defaults(func=cmd_run)
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'engine', None) == 'scrapy':
+        unsupported = [option for key, option in SCRAPY_UNSUPPORTED.items() if getattr(args, key) is not None]
+        if unsupported:
+            parser.error("not supported with --engine scrapy: {}".format(', '.join(unsupported)))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
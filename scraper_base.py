@@ -5,17 +5,25 @@
 # pylint: disable=cell-var-from-loop,fixme
 
 import os
+import re
 import sys
+import time
 import urllib
 import threading
+import collections
+import concurrent.futures
 import datetime
 import logging
 import json
 import traceback
+import contextlib
 
-import bs4
-import requests
-from requests.packages.urllib3.util import Retry  # pylint: disable=import-error
+# NOTE: `bs4`, `requests` and `urllib3` are imported where used, so that
+# importing the workers (e.g. for the `scrape.py` CLI) stays fast.
+
+from extraction import ExtractionStats
+from records import RecordStats, dumps as dumps_item
+import profiling
 
 
 LOG = logging.getLogger(__name__)
@@ -48,37 +56,220 @@ def parse_url(url, base=None):
     )
 
 
+CHARSET_RE = re.compile(r'''charset=["']?([\w.:-]+)''', re.IGNORECASE)
+
+
+def declared_charset(resp):
+    """ The charset from the response's Content-Type header, or None (no guessing) """
+    content_type = resp.headers.get('Content-Type') or ''
+    if isinstance(content_type, bytes):  # Scrapy headers.
+        content_type = content_type.decode('latin-1')
+    match = CHARSET_RE.search(content_type)
+    return match.group(1) if match else None
+
+
+class ResponseTooLarge(Exception):
+    """ The response body is over `WorkerBase.max_body_size` """
+
+
+# Per-thread state of the current `WorkerBase.req` call (deadline, retries count).
+REQUEST_CONTEXT = threading.local()
+
+
+class LatencyStats:
+    """ Latencies of the recent calls, for the percentiles """
+
+    def __init__(self, size=2000):
+        self.lock = threading.Lock()
+        self.recent = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        with self.lock:
+            self.recent.append(value)
+            self.count += 1
+
+    def percentile(self, pct):
+        with self.lock:
+            values = sorted(self.recent)
+        if not values:
+            return None
+        idx = min(len(values) - 1, int(len(values) * pct / 100))
+        return values[idx]
+
+
 class WorkerBase:
 
     items_file = None  # required for `self.write_item`.
 
     _max_errors = 100
 
-    retry_conf = Retry(
+    retry_params = dict(
         total=25, backoff_factor=0.5,
         status_forcelist=[500, 502, 503, 504, 521],
         method_whitelist=frozenset(['HEAD', 'TRACE', 'GET', 'PUT', 'OPTIONS', 'DELETE', 'POST']),
     )
+    retry_conf = None  # `retries.DeadlineRetry(**retry_params)` by default.
+
+    # Read the bodies in chunks (enforcing `max_body_size`) and parse the
+    # bytes with the declared charset instead of building `resp.text`.
+    # The compressed encodings are requested by `requests` itself
+    # (`gzip, deflate`, plus `br` with `brotli` installed).
+    streaming = False
+    # Max decoded body size (bytes) in the `streaming` mode; `None` for no limit.
+    max_body_size = 20 * 1024 * 1024
+    body_chunk_size = 64 * 1024
+
+    # Connection pools: hosts to keep the pools for, and connections per host
+    # (`None`: enough for `concurrency` plus the hedged requests).
+    pool_hosts = 30
+    pool_maxsize = None
+    # Send the https requests over HTTP/2 where supported (needs `httpx[http2]`).
+    http2 = False
+    # Cache the DNS lookups for this many seconds (process-wide); `None` to not.
+    dns_cache_ttl = None
 
     force = False
 
+    # Threads running the `map_` items, over all the (nested) `map_` calls.
+    concurrency = 1
+    # Max requests per second (over all threads); `None` for no limit.
+    rate_limit = None
+
+    # Overall time budget of a `req` call, including the retries (seconds).
+    request_deadline = 300
+    # Send a duplicate of a GET request that takes longer than this
+    # percentile of the recent request latencies (e.g. `95`); `None` to disable.
+    hedge_percentile = None
+    hedge_min_samples = 50
+    hedge_workers = 8  # max duplicate requests in flight; a slow request over this is not hedged.
+
+    # Profiling output prefix; see `profiling` (also `SCRAPER_PROFILE` env).
+    profile = None
+    # `price_history.PriceHistory` to also record the written items into (`scrape.py run --format history`).
+    history = None
+
+    # Item fields with the picture URLs (a string or a list), see `media`.
+    media_fields = ()
+    # Download the `media_fields` pictures in the background (`media.MediaDownloader`).
+    download_media = False
+    media_workers = 4
+    media_rate_limit = None
+
+    # Memory budget (`memguard`): the category pagers wait while the RSS is
+    # over the soft limit; over the hard one, the top retainers are logged.
+    memory_soft_limit_mb = None
+    memory_hard_limit_mb = None
+    memory_trace = False  # `tracemalloc` for the retainers (slow).
+
+    # How to find the items: 'html' (walking the categories pages, `main_i`)
+    # or 'sitemap' (`main_sitemap`: the sitemaps from `site_url`'s robots.txt
+    # or `sitemap_urls`, the URLs matching `sitemap_item_re`).
+    discovery = 'html'
+    site_url = None
+    sitemap_urls = ()
+    sitemap_item_re = None
+    # Re-fetch the already processed items with the sitemap `lastmod` at or after this (ISO date).
+    sitemap_since = None
+
+    # `records.ItemRecord` subclass the items are validated and written as; `None` for the plain dicts.
+    record_type = None
+
+    # Write a `run_report` per `main` run into this directory (default: `<prefix>_runs`); `False` to disable.
+    run_report_dir = None
+
+    # Save the category pagination state every this many pages (`checkpoints`); 0 to disable.
+    checkpoint_every = 1
+
     def __init__(self):
-        self._all_errors = []  # TODO: deque (limited)
+        # (exception type, exception, formatted traceback); without the
+        # traceback objects, which would keep all the frames' locals alive.
+        self._all_errors = collections.deque()
         self.mgmt_lock = threading.Lock()
+        self._reqr = None
+        self._rate_next_ts = 0.0
+        self.categories = None
+        self.processed_items = set()
+        self.failures = []  # (kind, url)
+        self.extract_stats = ExtractionStats()
+        self.record_stats = RecordStats()
+        self.profiler = profiling.get_profiler(self.profile)
+        # Without the profiling, only the per-stage timings (for the run report).
+        self.stage_timer = self.profiler or profiling.StageProfiler()
+        self.status_counts = collections.Counter()  # HTTP status -> responses count
+        self.req_stats = collections.Counter()
+        self.req_latencies = LatencyStats()
+        self.item_latencies = LatencyStats()
+        self._hedge_pool = None
+        self._hedge_slots = None  # (primary requests semaphore, duplicate requests semaphore)
+        self.media = None
+        self._checkpoints = None
+        self.memguard = None
+        self._map_pool = None  # shared by the (nested) `map_` calls.
+        self._map_slots = None  # free `_map_pool` threads.
+        self._in_flight = 0  # `map_` items being run.
+        self._throttled = 0  # of those, the ones waiting in `backpressure`.
+        self._map_context = threading.local()  # `tasks`: the `map_` items run by the thread.
+
+    @property
+    def reqr(self):
+        """ The `requests` session, created on the first use """
+        if self._reqr is None:
+            with self.mgmt_lock:
+                if self._reqr is None:
+                    self._reqr = self.make_session()
+        return self._reqr
+
+    def make_session(self):
+        import requests
+        from retries import DeadlineRetry
+
+        import connections
+
+        if self.dns_cache_ttl:
+            connections.install_dns_cache(self.dns_cache_ttl)
         session = requests.Session()
-        retry_conf = self.retry_conf
+        retry_conf = self.retry_conf or DeadlineRetry(**self.retry_params)
+        pool_maxsize = self.get_pool_maxsize()
         for prefix in ('http://', 'https://'):
-            session.mount(
-                prefix,
-                requests.adapters.HTTPAdapter(
+            adapter = None
+            if self.http2 and prefix == 'https://':
+                try:
+                    adapter = connections.Http2Adapter(
+                        max_connections=pool_maxsize,
+                        retries=self.retry_params.get('total', 5),
+                        backoff_factor=self.retry_params.get('backoff_factor', 0.5),
+                        status_forcelist=self.retry_params.get('status_forcelist', ()),
+                        backoff_max=self.retry_params.get('backoff_max'))
+                except ImportError:
+                    LOG.warning("No `httpx[http2]` for HTTP/2, using HTTP/1.1")
+            if adapter is None:
+                adapter = requests.adapters.HTTPAdapter(
                     max_retries=retry_conf,
-                    pool_connections=30, pool_maxsize=30,
-                ))
+                    pool_connections=self.pool_hosts, pool_maxsize=pool_maxsize,
+                )
+            session.mount(prefix, adapter)
         session.trust_env = False
-        self.reqr = session
-        self.categories = None
-        self.processed_items = set()
-        self.failures = []  # (kind, url)
+        return session
+
+    def get_pool_maxsize(self):
+        if self.pool_maxsize:
+            return self.pool_maxsize
+        in_flight = self.concurrency
+        if self.hedge_percentile is not None:
+            in_flight += self.hedge_workers
+        return max(10, in_flight)
+
+    def connection_stats(self):
+        """ Connections vs. requests of the session (see `connections.pool_stats`), DNS cache stats """
+        import connections
+        result = {}
+        if self._reqr is not None:
+            result = connections.pool_stats(self._reqr)
+        dns_cache = connections.get_dns_cache()
+        if dns_cache is not None:
+            result['dns'] = dict(dns_cache.stats)
+        return result
 
     @staticmethod
     def skip_none(dct):
@@ -94,13 +285,15 @@ class WorkerBase:
             if require:
                 raise
             return
-        for line in fobj:
+        for line_num, line in enumerate(fobj, 1):
+            line = line.strip()
             if not line:
                 continue
             try:
-                item = json.loads(line.strip())
-            except (TypeError, ValueError):
-                pass
+                item = json.loads(line)
+            except (TypeError, ValueError) as exc:
+                LOG.error("Bad JSON line %s:%d: %r", filename, line_num, exc)
+                continue
             yield item
 
     def collect_processed_items(self, key='url', filename=None):
@@ -112,10 +305,139 @@ class WorkerBase:
             self.processed_items.add(item.get(key))
         LOG.debug("Previously processed addresses: %d", len(self.processed_items))
 
-    def req(self, *args, allow_redirects=True, method='get', timeout=120, default_headers=True, **kwargs):
+    def count(self, name, value=1):
+        with self.mgmt_lock:
+            self.req_stats[name] += value
+
+    @contextlib.contextmanager
+    def deadline_scope(self, deadline=None):
+        """
+        Set the request deadline for the current thread, unless an outer scope already has.
+
+        Yields the deadline (`time.monotonic()`-based).
+        """
+        current = getattr(REQUEST_CONTEXT, 'deadline', None)
+        if current is not None:
+            yield current
+            return
+        if deadline is None:
+            deadline = time.monotonic() + self.request_deadline
+        REQUEST_CONTEXT.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            REQUEST_CONTEXT.deadline = None
+
+    def req(self, *args, method='get', hedge=None, **kwargs):
+        """
+        :param hedge: send a duplicate request if this one is slow (see `hedge_percentile`);
+            by default, for the GET requests only.
+        """
+        if hedge is None:
+            hedge = method.lower() == 'get'
+        with self.deadline_scope() as deadline:
+            hedge_delay = self._hedge_delay() if hedge else None
+            if hedge_delay is None:
+                return self._req_timed(deadline, args, dict(kwargs, method=method))
+            return self._req_hedged(deadline, hedge_delay, args, dict(kwargs, method=method))
+
+    def _hedge_delay(self):
+        if self.hedge_percentile is None:
+            return None
+        if len(self.req_latencies.recent) < self.hedge_min_samples:
+            return None
+        return self.req_latencies.percentile(self.hedge_percentile)
+
+    def _hedge_kwargs(self, kwargs):
+        """ Request arguments for the duplicate (hedge) request; must not block """
+        return kwargs
+
+    def _hedge_done(self, kwargs, hedge_kwargs, outcome):
+        """
+        Called after a hedged request, e.g. to return the duplicate's resources.
+
+        :param outcome: 'won' (the duplicate finished first), 'lost' or 'failed' (the duplicate).
+        """
+
+    def _req_timed(self, deadline, args, kwargs):
+        REQUEST_CONTEXT.deadline = deadline
+        REQUEST_CONTEXT.retries = 0
+        REQUEST_CONTEXT.deadline_exceeded = False
+        start = time.monotonic()
+        try:
+            kwargs['timeout'] = max(0.1, min(kwargs.get('timeout', 120), deadline - start))
+            result = self._req_once(*args, **kwargs)
+        finally:
+            self.count('requests')
+            self.count('retries', REQUEST_CONTEXT.retries)
+            if REQUEST_CONTEXT.deadline_exceeded:
+                self.count('deadline_exceeded')
+        self.req_latencies.add(time.monotonic() - start)
+        return result
+
+    def _get_hedge_pool(self):
+        """
+        -> (pool, primary slots, duplicate slots); the pool has a thread for
+        every slot, so a submitted request never waits in its queue (the wait
+        would count towards the hedge delay).
+        """
+        with self.mgmt_lock:
+            if self._hedge_pool is None:
+                primary_slots = max(1, self.concurrency)
+                self._hedge_slots = (
+                    threading.BoundedSemaphore(primary_slots), threading.BoundedSemaphore(self.hedge_workers))
+                self._hedge_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=primary_slots + self.hedge_workers, thread_name_prefix='hedge')
+        return (self._hedge_pool,) + self._hedge_slots
+
+    def _req_in_slot(self, slots, deadline, args, kwargs):
+        try:
+            return self._req_timed(deadline, args, kwargs)
+        finally:
+            slots.release()
+
+    def _req_hedged(self, deadline, hedge_delay, args, kwargs):
+        pool, primary_slots, hedge_slots = self._get_hedge_pool()
+        if not primary_slots.acquire(blocking=False):
+            # More requests in flight than expected: no hedging, on the calling thread.
+            return self._req_timed(deadline, args, kwargs)
+        primary = pool.submit(self._req_in_slot, primary_slots, deadline, args, dict(kwargs))
+        try:
+            return primary.result(timeout=hedge_delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not hedge_slots.acquire(blocking=False):
+            self.count('hedges_skipped')
+            return primary.result()
+        self.count('hedges')
+        hedge_kwargs = self._hedge_kwargs(dict(kwargs))
+        secondary = pool.submit(self._req_in_slot, hedge_slots, deadline, args, hedge_kwargs)
+        error = None
+        outcome = 'lost'
+        try:
+            for future in concurrent.futures.as_completed([primary, secondary]):
+                try:
+                    result = future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    error = exc
+                    if future is secondary:
+                        outcome = 'failed'
+                    continue
+                if future is secondary:
+                    self.count('hedge_wins')
+                    outcome = 'won'
+                return result
+            raise error
+        finally:
+            self._hedge_done(kwargs, hedge_kwargs, outcome)
+
+    def _req_once(self, *args, allow_redirects=True, method='get', timeout=120, default_headers=True, **kwargs):
 
         rfs = kwargs.pop('rfs', True)
 
+        if self.rate_limit:
+            self._wait_rate_limit()
+
         headers = dict(kwargs.pop('headers', None) or {})
 
         if default_headers:
@@ -125,6 +447,10 @@ class WorkerBase:
                 'Accept-Language': 'en-US,en;q=0.5',
             })
 
+        streaming = self.streaming and 'stream' not in kwargs
+        if streaming:
+            kwargs['stream'] = True
+
         resp = self.reqr.request(
             method,
             *args,
@@ -133,6 +459,13 @@ class WorkerBase:
             timeout=timeout,
             **kwargs)
 
+        with self.mgmt_lock:
+            self.status_counts[resp.status_code] += 1
+        if streaming:
+            self.read_body(resp)
+        elif not kwargs.get('stream'):
+            self.count('body_bytes', len(resp.content))
+
         if rfs == '200':
             if resp.status_code != 200:
                 raise Exception(
@@ -143,35 +476,97 @@ class WorkerBase:
 
         return resp
 
+    def read_body(self, resp):
+        """ Read a streamed response body in chunks, up to `max_body_size` (decoded) """
+        limit = self.max_body_size
+        if resp.raw is None or getattr(resp, '_content_consumed', False):
+            # Already read (e.g. by `connections.Http2Adapter`).
+            if limit and len(resp.content) > limit:
+                raise ResponseTooLarge(resp.url, len(resp.content))
+            return resp
+        length = resp.headers.get('Content-Length')
+        # Only meaningful for the not encoded bodies, but the encoded ones are smaller still.
+        if limit and length and length.isdigit() and int(length) > limit:
+            resp.close()
+            self.count('too_large')
+            raise ResponseTooLarge(resp.url, int(length))
+        chunks = []
+        size = 0
+        for chunk in resp.raw.stream(self.body_chunk_size, decode_content=True):
+            size += len(chunk)
+            if limit and size > limit:
+                resp.close()
+                self.count('too_large')
+                raise ResponseTooLarge(resp.url, size)
+            chunks.append(chunk)
+        resp._content = b''.join(chunks)  # pylint: disable=protected-access
+        resp._content_consumed = True  # pylint: disable=protected-access
+        resp.raw.release_conn()
+        self.count('body_bytes', size)
+        return resp
+
+    def _wait_rate_limit(self):
+        with self.mgmt_lock:
+            now = time.monotonic()
+            wait = self._rate_next_ts - now
+            self._rate_next_ts = max(now, self._rate_next_ts) + 1.0 / self.rate_limit
+        if wait > 0:
+            time.sleep(wait)
+
     def get(self, *args, **kwargs):
         return self.req(*args, method='get', **kwargs)
 
     def bs(self, resp):
-        # return bs4.BeautifulSoup(resp.content, 'html5lib')
+        import bs4
+        content = getattr(resp, 'content', None)
+        if content is None:
+            content = getattr(resp, 'body', None)  # Scrapy.
+        if self.streaming and isinstance(content, bytes):
+            # The bytes with the declared charset (the parser looks at
+            # `<meta charset>` if there's none): no `resp.text` copy and no
+            # charset detection over the whole body.
+            return bs4.BeautifulSoup(content, 'html5lib', from_encoding=declared_charset(resp))
         return bs4.BeautifulSoup(resp.text, 'html5lib')
 
+    @staticmethod
+    def release_response(resp, bs=None):
+        """ Free a processed page: the parsed tree (a lot of reference cycles) and its cached copy """
+        cached = getattr(resp, '__dict__', {}).pop('_bs_cached', None)
+        for tree in {id(tree): tree for tree in (bs, cached) if tree is not None}.values():
+            tree.decompose()
+
+    def extract(self, spec, item_bs, base_url=None, **kwargs):
+        return spec.extract(item_bs, base_url=base_url, stats=self.extract_stats, **kwargs)
+
+    def stage(self, name):
+        """ Context manager for the profiled crawl stages """
+        return self.stage_timer.stage(name)
+
     def try_(self, func, excs=(AttributeError, TypeError, ValueError), default=None, silent=False):
         try:
             return func()
         except excs as exc:
             exc_info = sys.exc_info()
-            with self.mgmt_lock:
-                self._all_errors.append(exc_info)
-                if len(self._all_errors) > self._max_errors:
-                    self._all_errors.pop(0)
-
+            # (type, exception, formatted traceback); the (expected) silent failures are not formatted.
+            tb_lines = None
             if not silent:
                 _, _, etb = exc_info
+                tb_lines = traceback.format_tb(etb)
                 LOG.error(
                     '`try_`-wrapped error: %r; %s',
                     exc,
-                    ''.join(traceback.format_tb(etb, 2)).replace('\n', ';'))
+                    ''.join(tb_lines[:2]).replace('\n', ';'))
                 if os.environ.get('IPDBG'):
                     traceback.print_exc()
                     import ipdb
                     _, _, sys.last_traceback = exc_info
                     ipdb.pm()
+            with self.mgmt_lock:
+                self._all_errors.append((type(exc), exc, ''.join(tb_lines) if tb_lines else None))
+                while len(self._all_errors) > self._max_errors:
+                    self._all_errors.popleft()
 
+            exc.__traceback__ = None
             return default
 
     @staticmethod
@@ -182,16 +577,70 @@ class WorkerBase:
 
     def map_(self, func, iterable, name='', excs=(Exception,)):
         name = name or repr(func)
-        # TODO: ThreadPool / multiprocessing
-        for item in iterable:
-            self.try_(lambda: func(item), excs=excs)
+        if self.concurrency <= 1:
+            for item in iterable:
+                self.try_(lambda: func(item), excs=excs)
+        else:
+            self._map_threaded(func, iterable, excs=excs)
         LOG.debug("Map %s done", name)
 
+    def _get_map_pool(self):
+        with self.mgmt_lock:
+            if self._map_pool is None:
+                self._map_slots = threading.BoundedSemaphore(self.concurrency)
+                self._map_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix='map')
+        return self._map_pool, self._map_slots
+
+    def _map_threaded(self, func, iterable, excs):
+        """
+        One pool of `concurrency` threads for all the `map_` calls, the nested
+        ones included (the categories, then their items). The top-level call
+        waits for a free thread per item (so the `iterable` is not consumed
+        upfront); a nested call, run by a pool thread, runs the item itself
+        when none is free (waiting could deadlock with the outer items
+        holding all the threads). So at most `concurrency` items run at once.
+        """
+        pool, slots = self._get_map_pool()
+        nested = getattr(self._map_context, 'tasks', 0) > 0
+        pending = set()
+        pending_lock = threading.Lock()
+
+        def run(item, slot=False):
+            context = self._map_context
+            context.tasks = getattr(context, 'tasks', 0) + 1
+            with self.mgmt_lock:
+                self._in_flight += 1
+            try:
+                self.try_(lambda: func(item), excs=excs)
+            finally:
+                context.tasks -= 1
+                with self.mgmt_lock:
+                    self._in_flight -= 1
+                if slot:
+                    slots.release()
+
+        def done(future):
+            with pending_lock:
+                pending.discard(future)
+
+        for item in iterable:
+            if slots.acquire(blocking=not nested):
+                future = pool.submit(run, item, slot=True)
+                with pending_lock:
+                    pending.add(future)
+                future.add_done_callback(done)
+            else:
+                run(item)
+        with pending_lock:
+            futures = list(pending)
+        concurrent.futures.wait(futures)
+
     @staticmethod
     def el_text(el, default=None, strip=True):
         if el is None:
             return default
-        if isinstance(el, bs4.element.NavigableString):
+        if isinstance(el, str):  # `bs4.element.NavigableString`
             result = str(el)
         else:
             result = el.text
@@ -201,13 +650,25 @@ class WorkerBase:
             result = result.strip()
         return result
 
+    def make_record(self, item_data):
+        """ item dict -> `record_type` record (or the same dict without a `record_type`) """
+        if self.record_type is None:
+            return item_data
+        return self.record_type.from_dict(item_data)
+
     def write_item(self, data, filename=None):
+        """ Append a dict or a record to the items file (`filename`); the records are validated """
         if filename is None:
             filename = self.items_file
-        data_s = json.dumps(data) + '\n'
+        if hasattr(data, 'to_dict'):
+            self.record_stats.add(data)
+            data = data.to_dict()
+        data_s = dumps_item(data)
         with self.mgmt_lock:
-            with open(filename, 'a', 1) as fobj:
+            with open(filename, 'ab') as fobj:
                 fobj.write(data_s)
+            if self.history is not None and filename == self.items_file:
+                self.history.add(data)
 
     def write_data(self, filename, data):
         with open(filename, 'w') as fo:
@@ -221,27 +682,172 @@ class WorkerBase:
     def main(self):
         assert self.items_file
         logging.basicConfig(level=logging.DEBUG)
-        return self.main_i()
+        started = time.time()
+        error = None
+        self.start_memguard()
+        if self.download_media:
+            self.start_media()
+        try:
+            if self.discovery == 'sitemap':
+                return self.main_sitemap()
+            return self.main_i()
+        except BaseException as exc:
+            error = repr(exc)
+            raise
+        finally:
+            self.close_media()
+            self.extract_stats.log(LOG)
+            self.record_stats.log(LOG)
+            self.log_req_stats()
+            self.write_run_report(started, error=error)
+
+    def write_run_report(self, started, error=None):
+        """ Write the `run_report` of the run started at `started` (`time.time()`); -> filename """
+        import run_report
+        if self.run_report_dir is False:
+            return None
+        directory = self.run_report_dir or '{}_runs'.format(self.items_file.rsplit('_items', 1)[0])
+        filename = os.path.join(
+            directory, '{}.json'.format(datetime.datetime.fromtimestamp(started).strftime('%Y%m%dT%H%M%S')))
+        return self.try_(
+            lambda: run_report.write_report(run_report.build_report(self, started, error=error), filename),
+            excs=(OSError, TypeError, ValueError))
+
+    def log_req_stats(self):
+        LOG.info(
+            "Requests: %s; request latency p50=%s p99=%s; item latency p50=%s p99=%s",
+            dict(self.req_stats),
+            self.req_latencies.percentile(50), self.req_latencies.percentile(99),
+            self.item_latencies.percentile(50), self.item_latencies.percentile(99))
+        LOG.info("Connections: %s", self.connection_stats())
+        if self.memguard is not None:
+            LOG.info("Memory: %s", self.memguard.summary())
+
+    def start_memguard(self):
+        from memguard import MemoryGuard
+        if self.memguard is None:
+            self.memguard = MemoryGuard(
+                soft_limit_mb=self.memory_soft_limit_mb, hard_limit_mb=self.memory_hard_limit_mb,
+                trace=self.memory_trace)
+            # The waiting pagers are not the work to wait for.
+            self.memguard.register_queue('map', lambda: max(0, self._in_flight - self._throttled))
+        return self.memguard
+
+    def backpressure(self, where=''):
+        """ Called by the producers (the category pagers) before the next page """
+        if self.memguard is None:
+            return
+        # The `map_` item the caller runs in (e.g. the category) waits too.
+        own_tasks = getattr(self._map_context, 'tasks', 0)
+        with self.mgmt_lock:
+            self._throttled += own_tasks
+        try:
+            self.memguard.throttle(where)
+        finally:
+            with self.mgmt_lock:
+                self._throttled -= own_tasks
+
+    def start_media(self):
+        from media import MediaDownloader
+        if self.media is None and self.media_fields:
+            prefix = self.items_file.rsplit('_items', 1)[0]
+            self.media = MediaDownloader(prefix, workers=self.media_workers, rate_limit=self.media_rate_limit)
+            if self.memguard is not None:
+                # The pagers wait while the downloads lag, before a full queue starts dropping the URLs.
+                self.memguard.register_queue(
+                    'media', self.media.queue.qsize, limit=self.media.queue_size * 3 // 4)
+        return self.media
+
+    def close_media(self):
+        if self.media is not None:
+            self.media.close()
+
+    def submit_media(self, item_data):
+        """
+        Queue the item's (dict or record) pictures for downloading; the already
+        stored ones get their hashes into the item's `media` (url -> sha256), the
+        rest are recorded in the media file with the `item_url` (the item
+        is not held back for them; `media.join_items` adds them later).
+        """
+        hashes = {}
+        for field in self.media_fields:
+            urls = item_data.get(field)
+            if isinstance(urls, str):
+                urls = [urls]
+            for url in urls or ():
+                sha256 = self.media.submit(url, item_url=item_data.get('url'), field=field)
+                if sha256 is not None:
+                    hashes[url] = sha256
+        if hashes:
+            if isinstance(item_data, dict):
+                item_data['media'] = hashes
+            else:
+                item_data.media = hashes
+        return item_data
+
+    def checkpoint(self, key):
+        """ Pagination checkpoint for the category `key` (ignored with `force`) """
+        from checkpoints import CheckpointStore
+        if self._checkpoints is None:
+            prefix = self.items_file.rsplit('_items', 1)[0]
+            self._checkpoints = CheckpointStore('{}_checkpoints'.format(prefix))
+        return self._checkpoints.checkpoint(
+            key, every=self.checkpoint_every, resume=bool(self.checkpoint_every) and not self.force)
 
     def main_i(self):
         raise NotImplementedError
 
-    def process_item_url(self, item_url, **kwargs):
-        if item_url in self.processed_items and not self.force:
+    def main_sitemap(self):
+        """ Process the items listed in the sitemaps, without walking the categories """
+        import sitemap
+        if not self.sitemap_item_re:
+            raise Exception("`sitemap_item_re` is required for the sitemap discovery")
+        if not self.force:
+            self.collect_processed_items()
+        sitemap_urls = self.sitemap_urls or sitemap.site_sitemaps(self.get, self.site_url)
+        LOG.info("Sitemaps: %r", sitemap_urls)
+        entries = sitemap.iter_sitemap_urls(self.get, sitemap_urls, url_re=self.sitemap_item_re)
+
+        def process_entry(entry):
+            lastmod = entry['lastmod']
+            refresh = bool(self.sitemap_since and lastmod and lastmod >= self.sitemap_since)
+            self.process_item_url(entry['url'], lastmod=lastmod, refresh=refresh)
+
+        self.map_(process_entry, entries)
+
+    def process_item_url(self, item_url, lastmod=None, refresh=False, **kwargs):
+        """
+        :param lastmod: the sitemap's last modification hint, stored with the item.
+        :param refresh: process even if already processed.
+        """
+        if item_url in self.processed_items and not (self.force or refresh):
             LOG.debug("Already processed: %s", item_url)
             return
 
-        item_resp = self.get(item_url)
+        start = time.monotonic()
+        with self.stage('fetch'):
+            item_resp = self.get(item_url)
         base_url = item_resp.url
         item_data = dict(url=base_url, ts=self.now())
-        item_bs = self.bs(item_resp)
+        if lastmod:
+            item_data['lastmod'] = lastmod
+        with self.stage('parse'):
+            item_bs = self.bs(item_resp)
 
-        res_data = self.process_item_url_i(base_url, item_bs, item_resp=item_resp, **kwargs)
+        with self.stage('extract'):
+            res_data = self.process_item_url_i(base_url, item_bs, item_resp=item_resp, **kwargs)
         item_data.update(res_data)
-
-        self.write_item(item_data)
+        item = self.make_record(item_data)
+        if self.media is not None:
+            self.submit_media(item)
+
+        with self.stage('write'):
+            self.write_item(item)
+        self.count('items')
+        self.release_response(item_resp, item_bs)
         with self.mgmt_lock:
             self.processed_items.add(item_url)
+        self.item_latencies.add(time.monotonic() - start)
 
     def process_item_url_i(self, base_url, item_bs, **kwargs):
         raise NotImplementedError
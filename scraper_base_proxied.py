@@ -4,10 +4,12 @@
 """
 # pylint: disable=cell-var-from-loop,fixme,abstract-method,arguments-differ
 
+import time
 import random
+import threading
+import collections
 from scraper_base import (
     urllib,
-    requests,
     WorkerBase,
     LOG,
 )
@@ -30,6 +32,22 @@ class WorkerBaseProxied(WorkerBase):
     proxies_iter = None
     proxy_arg = None
     proxy_retries = 3
+    proxy_check_url = 'https://example.com'
+    # Checked proxies kept aside for the hedged requests (see `hedge_percentile`).
+    proxy_spares = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Reentrant: advancing `proxies_iter` runs the proxy checks.
+        self.proxy_lock = threading.RLock()
+        # Advancing `proxies_iter` (a generator: one thread at a time).
+        self.proxies_iter_lock = threading.Lock()
+        self.spare_proxies = collections.deque()
+        self.spares_lock = threading.Lock()  # `spare_proxies`, `_spares_out`; never held over a check.
+        self._spares_out = 0  # spares taken by the hedges in flight.
+        self._spares_thread = None
+        self.proxy_check_lock = threading.Lock()
+        self._proxy_check_session = None
 
     def _is_proxied_url(self, url, **kwargs):  # pylint: disable=unused-argument
         return False
@@ -45,34 +63,155 @@ class WorkerBaseProxied(WorkerBase):
             tries = self.proxy_retries
 
         if self.proxy_arg is None:
-            self.proxies_iter = self.get_proxies()
-            self.proxy_arg = next(self.proxies_iter)
+            with self.proxy_lock:
+                if self.proxy_arg is None:
+                    self.proxies_iter = self.get_proxies()
+                    self.proxy_arg = self._next_proxy()
 
-        for retries_remain in reversed(range(tries)):
-            kwargs['proxies'] = self.proxy_arg
-            try:
-                result = super().req(url, *args, **kwargs)
-                self._check_for_error_page(result)
-                return result
-            except Exception:
-                if not retries_remain:
-                    raise
-                self.proxy_arg = next(self.proxies_iter)
+        with self.deadline_scope() as deadline:
+            for retries_remain in reversed(range(tries)):
+                kwargs['proxies'] = self.proxy_arg
+                try:
+                    result = super().req(url, *args, **kwargs)
+                    self._check_for_error_page(result)
+                    return result
+                except Exception:
+                    if not retries_remain or time.monotonic() >= deadline:
+                        raise
+                    self._switch_proxy(kwargs['proxies'])
         raise Exception("Not even trying")
 
+    def _next_proxy(self, required=True):
+        """ -> the next checked proxy; `None` (or an error if `required`) when the list is over """
+        with self.proxies_iter_lock:
+            try:
+                return next(self.proxies_iter)
+            except StopIteration:
+                if required:
+                    raise Exception("No more proxies")
+                return None
+
+    def _switch_proxy(self, failed_proxy_arg):
+        with self.proxy_lock:
+            # Might have been already switched by a concurrent request.
+            if self.proxy_arg is failed_proxy_arg:
+                with self.spares_lock:
+                    spare = self.spare_proxies.popleft() if self.spare_proxies else None
+                self.proxy_arg = spare or self._next_proxy()
+                self.count('proxy_switches')
+            return self.proxy_arg
+
+    def _refill_spares(self):
+        """ Check more proxies for the `spare_proxies` in the background (up to `proxy_spares` in all) """
+        with self.spares_lock:
+            if len(self.spare_proxies) + self._spares_out >= self.proxy_spares or self._spares_thread is not None:
+                return
+            self._spares_thread = threading.Thread(target=self._refill_spares_loop, name='proxy-spares', daemon=True)
+            self._spares_thread.start()
+
+    def _refill_spares_loop(self):
+        try:
+            while True:
+                with self.spares_lock:
+                    if len(self.spare_proxies) + self._spares_out >= self.proxy_spares:
+                        return
+                proxy_arg = self._next_proxy(required=False)
+                if proxy_arg is None:
+                    return
+                with self.spares_lock:
+                    self.spare_proxies.append(proxy_arg)
+        finally:
+            self._spares_thread = None
+
+    def _hedge_kwargs(self, kwargs):
+        """
+        Send the duplicate request through a spare checked proxy (the same
+        one when there's none at hand: the checks are not waited for here).
+        """
+        if 'proxies' in kwargs:
+            with self.spares_lock:
+                if self.spare_proxies and self.spare_proxies[0] is not kwargs['proxies']:
+                    kwargs['proxies'] = self.spare_proxies.popleft()
+                    self._spares_out += 1
+            self._refill_spares()
+        return kwargs
+
+    def _hedge_done(self, kwargs, hedge_kwargs, outcome):
+        """
+        Keep the proxy of the duplicate that was faster; the other one goes
+        back to the spares (the failed duplicate's proxy is dropped).
+        """
+        proxies = kwargs.get('proxies')
+        hedge_proxies = hedge_kwargs.get('proxies')
+        if hedge_proxies is None or hedge_proxies is proxies:
+            return
+        spare = None if outcome == 'failed' else hedge_proxies
+        # Not waiting for a proxy switch in progress (it runs the checks).
+        if outcome == 'won' and self.proxy_lock.acquire(blocking=False):
+            try:
+                if self.proxy_arg is proxies:
+                    self.proxy_arg = hedge_proxies
+                    self.count('proxy_switches')
+                    spare = proxies
+            finally:
+                self.proxy_lock.release()
+        with self.spares_lock:
+            self._spares_out -= 1
+            if spare is not None:
+                self.spare_proxies.append(spare)
+
     def get_proxies(self, **kwargs):
         for item in self.get_proxies_fpl(**kwargs):
             yield item
 
+    @property
+    def proxy_check_session(self):
+        """ Keep-alive session for the proxy checks (no retries: a slow proxy is just skipped) """
+        with self.proxy_check_lock:
+            if self._proxy_check_session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=1)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.trust_env = False
+                self._proxy_check_session = session
+        return self._proxy_check_session
+
+    def connection_stats(self):
+        result = super().connection_stats()
+        if self._proxy_check_session is not None:
+            import connections
+            result['proxy_check'] = connections.pool_stats(self._proxy_check_session)
+        return result
+
     def _check_proxy(self, arg):
+        session = self.proxy_check_session
         try:
-            resp = requests.get('https://example.com', proxies=arg, timeout=1)
+            resp = session.get(self.proxy_check_url, proxies=arg, timeout=1)
             resp.raise_for_status()
         except Exception as exc:
             LOG.debug("Proxy %r error %r", arg, exc)
+            self._drop_proxy_pools(session, arg)
             return False
+        self._drop_proxy_pools(session, None)
         return True
 
+    def _drop_proxy_pools(self, session, arg):
+        """
+        The adapter keeps a pool manager per proxy: drop the failed proxy's,
+        and keep (for the re-checks) at most `pool_hosts` of the good ones.
+        """
+        adapter = session.get_adapter(self.proxy_check_url)
+        with self.proxy_check_lock:
+            managers = adapter.proxy_manager
+            drop = set((arg or {}).values())
+            drop.update(list(managers)[:max(0, len(managers) - self.pool_hosts)])
+            for proxy in drop:
+                manager = managers.pop(proxy, None)
+                if manager is not None:
+                    manager.clear()
+
     def get_proxies_fpl(self):
         resp = self.req('https://www.free-proxy-list.net/')
         resp.raise_for_status()
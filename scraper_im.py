@@ -8,15 +8,28 @@ from scraper_base import (
     os, json, urllib,
     WorkerBase,
 )
+from extraction import ExtractionSpec, Field
+from records import ImItem
 
 
 class WorkerImBase(WorkerBase):
 
+    record_type = ImItem
     url_cats = None  # required
     cats_file = None  # required
 
     categories = None
 
+    media_fields = ('etc_image', 'etc_image_preview')
+
+    item_spec = ExtractionSpec('im_item', root='.product-popup', fields=[
+        Field('title', '.product-popup__title'),
+        Field('amount_text', '.product-popup__volume'),
+        Field('price_text', '.product-popup__price'),
+        Field('nutrition_title', '.nutrition .nutrition-title'),
+        Field('ingredients_text', '.ingredients__text'),
+    ])
+
     def main_i(self):
         assert self.url_cats
         assert self.cats_file
@@ -39,12 +52,7 @@ class WorkerImBase(WorkerBase):
 
         cats = []
         urls = []
-        for cat_el in cat_bs.select('a.taxon-title__link'):
-            # A category linked in a category-listing page.
-            cat_data = dict(
-                url=urllib.parse.urljoin(base_url, cat_el.get('href')),
-                title=self.el_text(cat_el),
-            )
+        for cat_data in self.parse_cat_links(cat_bs, base_url):
             # Linked page might be a category listing or a product listing.
             # Have to get the page; will request those pages twice as a result.
             subcats = self.get_cat_data(cat_data['url'])
@@ -57,29 +65,57 @@ class WorkerImBase(WorkerBase):
 
         return dict(cats=cats, urls=urls)
 
+    def parse_cat_links(self, cat_bs, base_url):
+        """ category-listing page -> linked categories (empty for a product listing) """
+        return list(
+            dict(
+                url=urllib.parse.urljoin(base_url, cat_el.get('href')),
+                title=self.el_text(cat_el),
+            )
+            for cat_el in cat_bs.select('a.taxon-title__link'))
+
+    @staticmethod
+    def cat_page_url(root_url, page):
+        return '{}/page/{}'.format(root_url, page)
+
+    @staticmethod
+    def parse_category_page(page_bs, base_url):
+        """ product listing page -> items urls, or None for a page past the end """
+        items_container_bs = page_bs.select_one('.products_with_filters_wrapper')
+        emptiness_message = items_container_bs.select_one('.empty-filter-message')
+        if emptiness_message is not None:  # supposedly, an empty page.
+            return None
+        items_bses = items_container_bs.select('li.product')
+        items_urls = list(
+            (item_bs.select_one('a.product__link') or {}).get('href')
+            for item_bs in items_bses)
+        return list(
+            urllib.parse.urljoin(base_url, item_url)
+            for item_url in items_urls if item_url)
+
     def process_category(self, root_url):
-        for page in range(1, 9000):
-            page_resp = self.get('{}/page/{}'.format(root_url, page))
+        checkpoint = self.checkpoint(root_url)
+        for page in range(checkpoint.get('cursor', 1), 9000):
+            self.backpressure(root_url)
+            with self.stage('category_fetch'):
+                page_resp = self.get(self.cat_page_url(root_url, page))
             base_url = page_resp.url
-            page_bs = self.bs(page_resp)
-            items_container_bs = page_bs.select_one('.products_with_filters_wrapper')
-            emptiness_message = items_container_bs.select_one('.empty-filter-message')
-            if emptiness_message is not None:  # supposedly, an empty page.
+            with self.stage('category_parse'):
+                page_bs = self.bs(page_resp)
+                items_urls = self.parse_category_page(page_bs, base_url)
+            self.release_response(page_resp, page_bs)
+            if items_urls is None:
                 break
-            items_bses = items_container_bs.select('li.product')
-            items_urls = list(
-                (item_bs.select_one('a.product__link') or {}).get('href')
-                for item_bs in items_bses)
-            items_urls = list(
-                urllib.parse.urljoin(base_url, item_url)
-                for item_url in items_urls if item_url)
             self.map_(self.process_item_url, items_urls)
+            checkpoint.update(cursor=page + 1)
+        checkpoint.done()
 
     def process_item_url_i(self, base_url, item_bs, **kwargs):
         item_data = {}
 
         item_bs_root = item_bs
-        item_bs = item_bs_root.select_one('.product-popup')
+        item_bs = self.item_spec.find_root(item_bs_root)
+        item_data.update(self.extract(self.item_spec, item_bs_root, base_url, root=item_bs))
 
         crumbs_bs = item_bs.select_one('.product-popup__breadcrumbs')
         crumb_els = self.try_(lambda: crumbs_bs.select('.product-popup__breadcrumbs-link'))
@@ -94,42 +130,34 @@ class WorkerImBase(WorkerBase):
             item_data['etc_image_preview'] = img_el.get('src')
             item_data['etc_image'] = img_el.get('data-zoom')
 
-        item_data['title'] = self.el_text(item_bs.select_one('.product-popup__title'))
-
-        item_data['amount_text'] = self.el_text(item_bs.select_one('.product-popup__volume'))
-
-        item_data['price_text'] = self.el_text(item_bs.select_one('.product-popup__price'))
-
         desc_el = item_bs.select_one('.product-popup__description')
         if desc_el:
             item_data['description'] = list(
                 el.decode()  # HTML almost-source.
                 for el in desc_el.children)
 
-        item_data['nutrition_title'] = self.el_text(item_bs.select_one('.nutrition .nutrition-title'))
         nutrition_props = item_bs.select('.nutrition .product-property')
         item_data['nutrition_properties'] = {
             self.el_text(elem.select_one('.product-property__name')):
             self.el_text(elem.select_one('.product-property__value'))
             for elem in nutrition_props}
 
-        item_data['ingredients_text'] = self.el_text(item_bs.select_one('.ingredients__text'))
-
         other_props = item_bs.select('.other-properties .product-property')
         item_data['properties'] = self.skip_none({
             self.el_text(elem.select_one('.product-property__name')):
             self.el_text(elem.select_one('.product-property__value'))
             for elem in other_props})
 
-        item_data['properties_links'] = self.skip_none({
-            self.el_text(elem.select_one('.product-property__name')):
-            self.try_(
-                lambda: urllib.parse.urljoin(
-                    base_url,
-                    elem.select_one('.product-property__value a.product-link').get('href')),
-                silent=True,
-            )
-            for elem in other_props})
+        properties_links = {}
+        for elem in other_props:
+            link_el = elem.select_one('.product-property__value a.product-link')
+            href = link_el.get('href') if link_el is not None else None
+            if href:
+                properties_links[self.el_text(elem.select_one('.product-property__name'))] = (
+                    urllib.parse.urljoin(base_url, href))
+        item_data['properties_links'] = self.skip_none(properties_links)
+        self.extract_stats.add(
+            self.item_spec.name, {('properties_links', 'ok' if properties_links else 'missing'): 1}, item=False)
 
         return item_data
 
@@ -151,6 +179,8 @@ class WorkerImCommon(WorkerImBase):
             worker = cls(name)
             worker.main()
 
+    site_url = 'https://instamart.ru'
+    sitemap_item_re = property(lambda self: r'^https://instamart\.ru/{}/products/'.format(self.name))
     url_cats = property(lambda self: 'https://instamart.ru/{}'.format(self.name))
     cats_file = property(lambda self: 'im_{}_categories.json'.format(self.name))
     items_file = property(lambda self: 'im_{}_items.jsl'.format(self.name))
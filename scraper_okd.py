@@ -7,11 +7,12 @@
 import re
 from scraper_base import (
     os, json, urllib,
-    bs4,
     LOG,
     parse_url,
 )
 from scraper_base_proxied import WorkerBaseProxied
+from extraction import ExtractionSpec, Field
+from records import OkdItem
 
 
 class WorkerOkey(WorkerBaseProxied):
@@ -21,6 +22,16 @@ class WorkerOkey(WorkerBaseProxied):
     cats_file = 'okd_categories.json'
     cat_items_file = 'okd_cat_items.jsl'
     items_file = 'okd_items.jsl'
+    record_type = OkdItem
+    site_url = url_host
+    # No `sitemap_item_re`: the product pages' paths look like the categories' ones.
+
+    item_spec = ExtractionSpec('okd_item', root='.product_page_content', fields=[
+        Field('title', '.main_header', within='.product-information'),
+        Field('price_crossed', '.crossed', within='.product_price'),
+        Field('price', '.price', within='.product_price'),
+        Field('characteristics_el', '.product-characteristics', value='element', within='.product-information'),
+    ])
 
     # ...
 
@@ -37,12 +48,15 @@ class WorkerOkey(WorkerBaseProxied):
                 title=title, message=message))
 
     def bs(self, resp, check_for_error_page=True, **kwargs):
-        bs = getattr(resp, '_bs_cached', None)
+        # Scrapy responses have `__slots__`: not cached (parsed once there anyway).
+        cache = getattr(resp, '__dict__', None)
+        bs = cache.get('_bs_cached') if cache is not None else None
         if bs is None:
             bs = super().bs(resp, **kwargs)
             if check_for_error_page and self._is_proxied_url(resp.url):
                 self._check_for_error_page(resp, bs)
-        setattr(resp, '_bs_cached', bs)
+        if cache is not None:
+            cache['_bs_cached'] = bs
         return bs
 
     # ...
@@ -76,9 +90,10 @@ class WorkerOkey(WorkerBaseProxied):
             return json.load(open(self.cats_file))
 
         cat_resp = self.get(self.url_cats)
-        base_url = cat_resp.url
-        cat_bs = self.bs(cat_resp)
+        return self.parse_cat_data(self.bs(cat_resp), cat_resp.url)
 
+    def parse_cat_data(self, cat_bs, base_url):
+        """ categories menu page -> categories list """
         base_el = cat_bs.select_one('#departmentsMenu')
         cats = base_el.select('a.menuLink')
 
@@ -105,9 +120,13 @@ class WorkerOkey(WorkerBaseProxied):
     def process_category(self, cat):
         return self.process_category_url(cat['url'])
 
-    def get_cat_page(self, store_id, catalog_id, cat_id, position=0, page_size=72, params=None):
-        resp = self.req(
-            'https://www.okeydostavka.ru/webapp/wcs/stores/servlet/ProductListingView',
+    def get_cat_page(self, *args, **kwargs):
+        return self.req(**self.cat_page_request(*args, **kwargs))
+
+    def cat_page_request(self, store_id, catalog_id, cat_id, position=0, page_size=72, params=None):
+        """ -> `req` arguments for a category listing page """
+        return dict(
+            url='https://www.okeydostavka.ru/webapp/wcs/stores/servlet/ProductListingView',
             method='post',
             params=dict(
                 params or {},
@@ -187,7 +206,6 @@ class WorkerOkey(WorkerBaseProxied):
                 # userLastName='',
             ),
         )
-        return resp
 
     def process_category_url(self, root_url):
         """ category base page url -> None; dumps the category items urls into a file """
@@ -196,32 +214,89 @@ class WorkerOkey(WorkerBaseProxied):
             LOG.debug("Already processed category listing: %s", root_url)
             return
 
-        all_items_urls = self.process_category_url_i(root_url)
+        checkpoint = self.checkpoint(root_url)
+        all_items_urls = self.process_category_url_i(root_url, checkpoint=checkpoint)
         cat_data = dict(
             url=root_url,
             ts=self.now(),
             item_urls=all_items_urls or [],
         )
         self.write_item(cat_data, filename=self.cat_items_file)
+        # Only now: a crash before the record is written resumes the category.
+        checkpoint.done()
 
-    def process_category_url_i(self, root_url):
-        """ category base page url -> category items urls """
+    def process_category_url_i(self, root_url, checkpoint=None):
+        """
+        category base page url -> category items urls
+
+        :param checkpoint: the pagination checkpoint; left for the caller to finish.
+        """
         base_page_resp = self.get(root_url)
         base_url = base_page_resp.url
         base_page_bs = self.bs(base_page_resp)
 
-        products = base_page_bs.select_one('.product_listing_container .product_name')
-        if not products:
-            subcats = base_page_bs.select('div.row.categories > div')
-            if subcats:
-                LOG.debug("A non-terminal category (no products, %d subcategories): %s", len(subcats), root_url)
-                return None
-            # else:
+        page_kind, pages_params = self.parse_category_base(base_page_bs, base_url)
+        if page_kind != 'error':
+            self.release_response(base_page_resp, base_page_bs)
+        if page_kind == 'subcategories':
+            LOG.debug("A non-terminal category (no products): %s", root_url)
+            return None
+        if page_kind == 'error':
             with open('.okd_last_error_page.html', 'wb') as fo:
                 fo.write(base_page_resp.content)
             raise Exception("Probably an error page at {}".format(root_url))
 
         LOG.debug("Category page: %s", root_url)
+        store_id = pages_params['storeId']
+        catalog_id = pages_params['catalogId']
+        cat_id = pages_params['categoryId']
+
+        if checkpoint is None:
+            checkpoint = self.checkpoint(root_url)
+        position = checkpoint.get('cursor', 0)
+        # Only the cursor is saved; the new URLs of each page are appended to the 'seen' log.
+        all_items_urls = checkpoint.read_log('seen')
+        all_items_urls_set = set(all_items_urls)
+        for _ in range(1, 9000):
+            self.backpressure(root_url)
+            with self.stage('category_fetch'):
+                page_resp = self.get_cat_page(
+                    store_id=store_id, catalog_id=catalog_id, cat_id=cat_id,
+                    position=position)
+            with self.stage('category_parse'):
+                page_bs = self.bs(page_resp)
+                page_items_urls = self.parse_cat_page(page_bs, base_url)
+            self.release_response(page_resp, page_bs)
+            LOG.info("Page items: %r", len(page_items_urls))
+            if not page_items_urls:
+                break
+            position += len(page_items_urls)
+
+            new_page_items_urls = list(
+                url for url in page_items_urls
+                if url not in all_items_urls_set)
+            LOG.info("Page items (new): %r", len(new_page_items_urls))
+
+            all_items_urls.extend(new_page_items_urls)
+            all_items_urls_set.update(new_page_items_urls)
+            checkpoint.append('seen', new_page_items_urls)
+            checkpoint.update(cursor=position)
+
+        return all_items_urls
+
+    def parse_category_base(self, base_page_bs, base_url):
+        """
+        category base page -> (page kind, listing pages params)
+
+        page kind is 'products', 'subcategories' or 'error'.
+        """
+        products = base_page_bs.select_one('.product_listing_container .product_name')
+        if not products:
+            subcats = base_page_bs.select('div.row.categories > div')
+            if subcats:
+                return 'subcategories', None
+            return 'error', None
+
         pages_params = None
 
         scripts = base_page_bs.select('script')
@@ -247,44 +322,22 @@ class WorkerOkey(WorkerBaseProxied):
                 if input_el.get('value')}
             pages_params['categoryId'] = base_url.rsplit('-', 2)[-2]
 
-        store_id = pages_params['storeId']
-        catalog_id = pages_params['catalogId']
-        cat_id = pages_params['categoryId']
-
-        position = 0
-        all_items = []
-        all_items_urls = []
-        all_items_urls_set = set()
-        for _ in range(1, 9000):
-            page_resp = self.get_cat_page(
-                store_id=store_id, catalog_id=catalog_id, cat_id=cat_id,
-                position=position)
-            page_bs = self.bs(page_resp)
-            page_items = page_bs.select('.product_name > a')
-            page_items_urls = list(
-                urllib.parse.urljoin(base_url, item_el['href'])
-                for item_el in page_items)
-            LOG.info("Page items: %r", len(page_items))
-            if not page_items:
-                break
-            position += len(page_items)
-
-            new_page_items_urls = list(
-                url for url in page_items_urls
-                if url not in all_items_urls_set)
-            LOG.info("Page items (new): %r", len(new_page_items_urls))
-
-            all_items.extend(page_items)
-            all_items_urls.extend(new_page_items_urls)
-            all_items_urls_set.update(new_page_items_urls)
+        return 'products', pages_params
 
-        return all_items_urls
+    @staticmethod
+    def parse_cat_page(page_bs, base_url):
+        """ category listing page -> items urls """
+        page_items = page_bs.select('.product_name > a')
+        return list(
+            urllib.parse.urljoin(base_url, item_el['href'])
+            for item_el in page_items)
 
     def process_item_url_i(self, base_url, item_bs, **kwargs):
         item_data = {}
 
         item_base_bs = item_bs
-        item_bs = item_base_bs.select_one('.product_page_content')
+        item_bs = self.item_spec.find_root(item_base_bs)
+        item_data.update(self.extract(self.item_spec, item_base_bs, base_url, root=item_bs))
 
         crumbs_bs = item_bs.select_one('#widget_breadcrumb')
         crumbs = list(
@@ -297,15 +350,7 @@ class WorkerOkey(WorkerBaseProxied):
             for elem in crumbs_bs.select('li.current'))
         item_data['crumbs'] = crumbs
 
-        info_bs = item_bs.select_one('.product-information')
-
-        item_data['title'] = self.el_text(info_bs.select_one('.main_header'))
-
-        price_bs = item_bs.select_one('.product_price')
-        item_data['price_crossed'] = self.el_text(price_bs.select_one('.crossed'))
-        item_data['price'] = self.el_text(price_bs.select_one('.price'))
-
-        chars_el = info_bs.select_one('.product-characteristics')
+        chars_el = item_data.pop('characteristics_el')
         if self.el_text(chars_el):
             item_data['characteristics_html'] = chars_el.decode()
 
@@ -313,7 +358,7 @@ class WorkerOkey(WorkerBaseProxied):
             name = None
             value = None
             for subelem in prop_elem.children:
-                if isinstance(subelem, bs4.element.NavigableString):
+                if isinstance(subelem, str):  # `bs4.element.NavigableString`
                     continue
                 elif (subelem.get('id') or '').startswith('descAttributeName_'):
                     name = self.el_text(subelem)
@@ -323,9 +368,11 @@ class WorkerOkey(WorkerBaseProxied):
 
         props_els = item_bs.select('.widget-list > li')
         props = {}
+        incomplete = 0
         for elem in props_els:
-            name, value = self.try_(lambda: parse_prop_elem(elem)) or (None, None)
+            name, value = parse_prop_elem(elem)
             if not name or value is None:
+                incomplete += 1
                 continue
             name_base = name
             for idx in range(10):
@@ -336,6 +383,9 @@ class WorkerOkey(WorkerBaseProxied):
             props[name] = value
 
         item_data['props'] = props
+        self.extract_stats.add(self.item_spec.name, {
+            ('props', 'missing' if not props else 'partial' if incomplete else 'ok'): 1,
+        }, item=False)
         return item_data
 
 
@@ -9,16 +9,38 @@ from scraper_base import (
     urllib,
     WorkerBase,
 )
+from extraction import ExtractionSpec, Field
+from records import UtkItem
 
 
 class WorkerUtk(WorkerBase):
 
     items_file = 'utk_items.jsl'
+    record_type = UtkItem
+    site_url = 'https://www.utkonos.ru'
+    sitemap_item_re = r'^https://www\.utkonos\.ru/item/'
+    media_fields = ('pictures',)
 
     url_cats = 'https://www.utkonos.ru/cache/catalogue/megamenu/site/2/type/guest.html?_=1537439034420'
     url_cat_main = 'https://www.utkonos.ru/cat/{cat_id}'
     url_cat_page = 'https://www.utkonos.ru/cat/{cat_id}/page/{page_num}'
 
+    item_spec = ExtractionSpec('utk_item', fields=[
+        # 'Артикул: ...'
+        Field('etc_preamble_original', '.goods_view_item-preamble_original', within='.goods_view_item-preamble'),
+        Field(
+            'etc_rating', '.goods_view_item-preamble_rating span.selected',
+            value='@data-ratingpos', post=int, within='.goods_view_item-preamble'),
+        Field(
+            'etc_rating_numvotes', '.number_votes_text',
+            post=lambda val: int(val.replace(')', '').replace('(', '')),
+            within='.goods_view_item-preamble'),
+        Field('title', '.goods_view_item-action_header', within='.goods_view_item-action'),
+        Field('etc_variants_something', '.goods_variants_property-module', within='.goods_view_item-action'),
+        Field('etc_price_check', '.goods_price', value='@data-static-now-price', within='.goods_view_item-action'),
+        Field('etc_max_purchase', '.goods_view_item-limit_max', within='.goods_view_item-action'),
+    ])
+
     def main_i(self):
         if not self.force:
             self.collect_processed_items()
@@ -32,7 +54,10 @@ class WorkerUtk(WorkerBase):
         cat_resp = self.get(self.url_cats)
         cat_bs = self.bs(cat_resp)
         # self._debug(cat_s[:1000])
+        return self.parse_cat_data(cat_bs)
 
+    def parse_cat_data(self, cat_bs):
+        """ megamenu page -> categories list """
         cats = cat_bs.select('a.module_catalogue_megamenu-item')
         cats = list(
             dict(
@@ -63,24 +88,42 @@ class WorkerUtk(WorkerBase):
 
     def process_category(self, cat):
         # max_page = self.get_max_page(...)
-        for page in range(1, 9000):
+        checkpoint = self.checkpoint(self.cat_page_url(cat, 1))
+        for page in range(checkpoint.get('cursor', 1), 9000):
+            self.backpressure(cat['cat_id'])
             page_res = self.process_cat_page(cat=cat, page=page)
             # A bit tricky to parallelize because of this:
             if page_res and page_res.get('status') == 'redirected':
                 break
+            checkpoint.update(cursor=page + 1)
+        checkpoint.done()
 
-    def process_cat_page(self, cat, page):
+    def cat_page_url(self, cat, page):
         if page == 1:
-            url = self.url_cat_main.format(cat_id=cat['cat_id'])
-        else:
-            url = self.url_cat_page.format(cat_id=cat['cat_id'], page_num=page)
+            return self.url_cat_main.format(cat_id=cat['cat_id'])
+        return self.url_cat_page.format(cat_id=cat['cat_id'], page_num=page)
 
-        page_resp = self.get(url, allow_redirects=False)
-        if page_resp.status_code in (301, 302):  # pages over limit redirect to non-paged `url2`
+    def process_cat_page(self, cat, page):
+        url = self.cat_page_url(cat, page)
+        with self.stage('category_fetch'):
+            page_resp = self.get(url, allow_redirects=False)
+        if page_resp.status_code in self.cat_page_end_statuses:
             return dict(status='redirected')
         base_url = page_resp.url
-        page_bs = self.bs(page_resp)
+        with self.stage('category_parse'):
+            page_bs = self.bs(page_resp)
+            items_urls = self.parse_cat_page(page_bs, base_url)
+        self.release_response(page_resp, page_bs)
 
+        self.map_(self.process_item_url, items_urls)
+        return {}
+
+    # Pages over limit redirect to non-paged `url_cat_main`.
+    cat_page_end_statuses = (301, 302)
+
+    @staticmethod
+    def parse_cat_page(page_bs, base_url):
+        """ category listing page -> items urls """
         items_special = page_bs.select('.goods_view_timetobuy > .goods_view_timetobuy-view')
         items_main = page_bs.select('.goods_view_box > .goods_view-item')
         items = list(items_special) + list(items_main)
@@ -88,13 +131,10 @@ class WorkerUtk(WorkerBase):
         items_urls = list(
             (item_bs.select_one('a.goods_caption') or {}).get('href')
             for item_bs in items)
-        items_urls = list(
+        return list(
             urllib.parse.urljoin(base_url, item_url)
             for item_url in items_urls if item_url)
 
-        self.map_(self.process_item_url, items_urls)
-        return {}
-
     def process_item_url_i(self, base_url, item_bs, **kwargs):
         item_data = {}
         pic_bs = item_bs.select_one('.goods_view_item-pic')
@@ -113,29 +153,13 @@ class WorkerUtk(WorkerBase):
             )
             for el in crumbs_bs.select('.module_bread_crumbs-item > a'))
 
-        preamble_bs = item_bs.select_one('.goods_view_item-preamble')
-        # 'Артикул: ...'
-        item_data['etc_preamble_original'] = self.try_(lambda: self.el_text(
-            preamble_bs.select_one('.goods_view_item-preamble_original')))
-        item_data['etc_rating'] = self.try_(lambda: int(
-            preamble_bs.select_one('.goods_view_item-preamble_rating')
-            .select_one('span.selected').get('data-ratingpos')))
-        item_data['etc_rating_numvotes'] = self.try_(lambda: int(
-            self.el_text(preamble_bs.select_one('.number_votes_text'))
-            .replace(')', '').replace('(', '')))
-
-        action_bs = item_bs.select_one('.goods_view_item-action')
+        item_data.update(self.extract(self.item_spec, item_bs, base_url))
         # NOTE: can also be grabbed from the last cru
-        item_data['title'] = self.try_(lambda: self.el_text(
-            action_bs.select_one('.goods_view_item-action_header')))
         item_data['title'] = item_data.get('title') or self.try_(lambda: self.el_text(
             crumbs_bs.select('.module_bread_crumbs-item')[-1]))
 
-        item_data['etc_variants_something'] = self.try_(lambda: self.el_text(
-            action_bs.select_one('.goods_variants_property-module')))
-
+        action_bs = item_bs.select_one('.goods_view_item-action')
         prices_el = action_bs.select_one('.goods_price')
-        item_data['etc_price_check'] = prices_el.get('data-static-now-price')
         for price_el in prices_el.select('.goods_price-item.current'):
             # NOTE: `.goods_price-item::after { content: '\20BD';` (“₽”)
             # suggests it is always in RUB.
@@ -150,25 +174,27 @@ class WorkerUtk(WorkerBase):
                 self.el_text(price_el).replace(',', '.').replace(' ', '')))
             item_data[price_key] = value
 
-        item_data['etc_max_purchase'] = self.try_(lambda: self.el_text(
-            action_bs.select_one('.goods_view_item-limit_max')))
-
         item_data['etc_descriptions'] = list(
             self.el_text(el)
-            for el in item_bs.select_one('#goods_view_item-tabs=description > div').children)
-
-        props = item_bs.select('.goods_view_item-property_item')
-        item_data['props'] = {
-            self.try_(lambda: self.el_text(
-                el.select_one('.goods_view_item-property_title'))):
-            self.try_(lambda: self.el_text(
-                el.select_one('.goods_view_item-property_value')))
-            for el in props}
-        item_data['etc_props_links'] = {
-            self.try_(lambda: self.el_text(
-                el.select_one('.goods_view_item-property_title'))):
-            self.try_(lambda: el.select_one('.goods_view_item-property_value > a').get('href'))
-            for el in props}
+            for el in item_bs.select_one('[id="goods_view_item-tabs=description"] > div').children)
+
+        props = {}
+        props_links = {}
+        incomplete = 0
+        for el in item_bs.select('.goods_view_item-property_item'):
+            name = self.el_text(el.select_one('.goods_view_item-property_title'))
+            value = self.el_text(el.select_one('.goods_view_item-property_value'))
+            link_el = el.select_one('.goods_view_item-property_value > a')
+            props[name] = value
+            props_links[name] = link_el.get('href') if link_el is not None else None
+            if name is None or value is None:
+                incomplete += 1
+        item_data['props'] = props
+        item_data['etc_props_links'] = props_links
+        self.extract_stats.add(self.item_spec.name, {
+            ('props', 'missing' if not props else 'partial' if incomplete else 'ok'): 1,
+            ('etc_props_links', 'ok' if any(props_links.values()) else 'missing'): 1,
+        }, item=False)
 
         return item_data
 
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Scrapy-based crawl engine for the workers.
+
+The spiders reuse the workers' parsing code (`parse_cat_data`,
+`parse_cat_page`, `process_item_url_i`, ...) and only replace the fetching
+and the scheduling with Scrapy's (concurrent requests, autothrottle,
+retries). Items (the workers' records) are written by `WorkerItemsPipeline`
+through the worker's `write_item`, i.e. into the same `*_items.jsl` files
+with the same schema.
+
+Usage:
+
+    ./scrapy_engine.py okd
+    ./scrapy_engine.py utk
+    ./scrapy_engine.py im:lenta
+"""
+# pylint: disable=fixme,abstract-method
+
+import sys
+import time
+import urllib.parse
+
+import scrapy
+
+from scraper_base import LOG
+
+
+DEFAULT_SETTINGS = {
+    'USER_AGENT': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:62.0) Gecko/20100101 Firefox/62.0',
+    'DEFAULT_REQUEST_HEADERS': {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.5',
+    },
+    'AUTOTHROTTLE_ENABLED': True,
+    'AUTOTHROTTLE_TARGET_CONCURRENCY': 8.0,
+    'CONCURRENT_REQUESTS': 32,
+    'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+    'RETRY_TIMES': 5,
+    'RETRY_HTTP_CODES': [500, 502, 503, 504, 521, 522, 524, 408, 429],
+    'DOWNLOAD_TIMEOUT': 120,
+    'COOKIES_ENABLED': True,
+    'ITEM_PIPELINES': {'scrapy_engine.WorkerItemsPipeline': 300},
+    'LOG_LEVEL': 'INFO',
+}
+
+
+class WorkerItemsPipeline:
+    """ Writes the items into the worker's items file """
+
+    def __init__(self, crawler=None):
+        self.crawler = crawler
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_item(self, item, spider=None):
+        worker = (spider or self.crawler.spider).worker
+        if worker.media is not None:
+            worker.submit_media(item)
+        worker.write_item(item)
+        worker.count('items')
+        with worker.mgmt_lock:
+            worker.processed_items.add(item.get('url'))
+        return item
+
+    def open_spider(self, spider=None):
+        worker = (spider or self.crawler.spider).worker
+        self.started = time.time()
+        if worker.download_media:
+            worker.start_media()
+
+    def close_spider(self, spider=None):
+        worker = (spider or self.crawler.spider).worker
+        worker.close_media()
+        # The fetching counters are Scrapy's, not the worker's.
+        prefix = 'downloader/response_status_count/'
+        for key, value in self.crawler.stats.get_stats().items():
+            if key.startswith(prefix):
+                worker.status_counts[int(key[len(prefix):])] += value
+        worker.count('requests', self.crawler.stats.get_value('downloader/request_count', 0))
+        worker.count('retries', self.crawler.stats.get_value('retry/count', 0))
+        worker.count('body_bytes', self.crawler.stats.get_value('downloader/response_bytes', 0))
+        worker.write_run_report(self.started or time.time())
+
+
+class WorkerSpiderBase(scrapy.Spider):
+
+    def __init__(self, *args, worker=None, proxy=None, **kwargs):
+        """
+        :param proxy: proxy url for all the requests (the workers' proxy lists are not used here).
+        """
+        super().__init__(*args, **kwargs)
+        self.worker = worker or self.make_worker()
+        self.proxy = proxy
+        if not self.worker.force:
+            self.worker.collect_processed_items()
+
+    def make_worker(self):
+        raise NotImplementedError
+
+    async def start(self):
+        # Scrapy >= 2.13; the older versions call `start_requests` directly.
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        yield self.request(self.worker.url_cats, callback=self.parse_cats)
+
+    def parse_cats(self, response):
+        raise NotImplementedError
+
+    def request(self, url, callback, **kwargs):
+        meta = dict(kwargs.pop('meta', None) or {})
+        if self.proxy:
+            meta['proxy'] = self.proxy
+        return scrapy.Request(url, callback=callback, meta=meta, **kwargs)
+
+    def bs(self, response):
+        return self.worker.bs(response)
+
+    def item_requests(self, items_urls):
+        for item_url in items_urls:
+            if item_url in self.worker.processed_items and not self.worker.force:
+                continue
+            yield self.request(item_url, callback=self.parse_item)
+
+    def parse_item(self, response):
+        worker = self.worker
+        item_data = dict(url=response.url, ts=worker.now())
+        item_bs = self.bs(response)
+        item_data.update(worker.process_item_url_i(response.url, item_bs, item_resp=response))
+        # The record (a dataclass item for Scrapy) goes through the pipeline.
+        yield worker.make_record(item_data)
+
+
+class OkdSpider(WorkerSpiderBase):
+
+    name = 'okd'
+
+    def make_worker(self):
+        from scraper_okd import WorkerOkey
+        return WorkerOkey()
+
+    def parse_cats(self, response):
+        cats = self.worker.parse_cat_data(self.bs(response), response.url)
+        self.worker.write_data(self.worker.cats_file, cats)
+        for cat in cats:
+            if cat['url'] in self.worker.processed_items and not self.worker.force:
+                continue
+            yield self.request(cat['url'], callback=self.parse_category, cb_kwargs=dict(root_url=cat['url']))
+
+    def cat_page_request(self, pages_params, position, cb_kwargs):
+        args = self.worker.cat_page_request(
+            store_id=pages_params['storeId'],
+            catalog_id=pages_params['catalogId'],
+            cat_id=pages_params['categoryId'],
+            position=position)
+        url = '{}?{}'.format(args['url'], urllib.parse.urlencode(args['params']))
+        meta = dict(proxy=self.proxy) if self.proxy else {}
+        return scrapy.FormRequest(
+            url,
+            method=args['method'].upper(),
+            headers=args['headers'],
+            formdata={key: str(val) for key, val in args['data'].items()},
+            callback=self.parse_cat_page,
+            cb_kwargs=dict(cb_kwargs, pages_params=pages_params, position=position),
+            meta=meta,
+            dont_filter=True)
+
+    def parse_category(self, response, root_url):
+        page_kind, pages_params = self.worker.parse_category_base(self.bs(response), response.url)
+        if page_kind == 'error':
+            raise Exception("Probably an error page at {}".format(root_url))
+        if page_kind == 'subcategories':
+            self.worker.write_item(
+                dict(url=root_url, ts=self.worker.now(), item_urls=[]),
+                filename=self.worker.cat_items_file)
+            return
+        yield self.cat_page_request(
+            pages_params, 0, dict(root_url=root_url, base_url=response.url, items_urls=[]))
+
+    def parse_cat_page(self, response, root_url, base_url, items_urls, pages_params, position):
+        page_items_urls = self.worker.parse_cat_page(self.bs(response), base_url)
+        LOG.info("Page items: %r", len(page_items_urls))
+        if not page_items_urls:
+            self.worker.write_item(
+                dict(url=root_url, ts=self.worker.now(), item_urls=items_urls),
+                filename=self.worker.cat_items_file)
+            return
+        seen = set(items_urls)
+        new_items_urls = [url for url in page_items_urls if url not in seen]
+        items_urls.extend(new_items_urls)
+        yield from self.item_requests(new_items_urls)
+        yield self.cat_page_request(
+            pages_params, position + len(page_items_urls),
+            dict(root_url=root_url, base_url=base_url, items_urls=items_urls))
+
+
+class UtkSpider(WorkerSpiderBase):
+
+    name = 'utk'
+
+    def make_worker(self):
+        from scraper_utk import WorkerUtk
+        return WorkerUtk()
+
+    def parse_cats(self, response):
+        cats = self.worker.parse_cat_data(self.bs(response))
+        self.worker.write_data('utk_categories.json', cats)
+        for cat in cats:
+            yield self.cat_page_request(cat, 1)
+
+    def cat_page_request(self, cat, page):
+        return self.request(
+            self.worker.cat_page_url(cat, page),
+            callback=self.parse_cat_page,
+            cb_kwargs=dict(cat=cat, page=page),
+            meta=dict(
+                dont_redirect=True,
+                handle_httpstatus_list=list(self.worker.cat_page_end_statuses)))
+
+    def parse_cat_page(self, response, cat, page):
+        if response.status in self.worker.cat_page_end_statuses:
+            return
+        yield from self.item_requests(self.worker.parse_cat_page(self.bs(response), response.url))
+        yield self.cat_page_request(cat, page + 1)
+
+
+class ImSpider(WorkerSpiderBase):
+
+    name = 'im'
+
+    def __init__(self, *args, store='lenta', **kwargs):
+        self.store = store
+        super().__init__(*args, **kwargs)
+
+    def make_worker(self):
+        from scraper_im import WorkerImCommon
+        return WorkerImCommon(self.store)
+
+    def parse_cats(self, response):
+        cats = self.worker.parse_cat_links(self.bs(response), response.url)
+        if not cats:
+            # A product listing.
+            yield self.cat_page_request(response.url, 1)
+            return
+        for cat in cats:
+            yield self.request(cat['url'], callback=self.parse_cats)
+
+    def cat_page_request(self, root_url, page):
+        return self.request(
+            self.worker.cat_page_url(root_url, page),
+            callback=self.parse_cat_page,
+            cb_kwargs=dict(root_url=root_url, page=page))
+
+    def parse_cat_page(self, response, root_url, page):
+        items_urls = self.worker.parse_category_page(self.bs(response), response.url)
+        if items_urls is None:
+            return
+        yield from self.item_requests(items_urls)
+        yield self.cat_page_request(root_url, page + 1)
+
+
+SPIDERS = dict(okd=OkdSpider, utk=UtkSpider, im=ImSpider)
+
+
+def crawl_workers(workers, settings=None):
+    """
+    Crawl with the (configured) workers, all the spiders in one process
+    (the Twisted reactor can not be restarted).
+
+    :param workers: [(name, worker), ...]; name: 'okd', 'utk' or 'im'.
+    """
+    from scrapy.crawler import CrawlerProcess
+    process = CrawlerProcess(dict(DEFAULT_SETTINGS, **(settings or {})))
+    for name, worker in workers:
+        process.crawl(SPIDERS[name], worker=worker)
+    process.start()
+
+
+def crawl(worker_name, settings=None, **spider_kwargs):
+    """
+    :param worker_name: 'okd', 'utk', 'im:<store>' or 'im' (all the known stores).
+    """
+    from scrapy.crawler import CrawlerProcess
+    name, _, store = worker_name.partition(':')
+    if name == 'im' and not store:
+        from scraper_im import WorkerImCommon
+        stores = WorkerImCommon.known_names
+    else:
+        stores = [store or None]
+    process = CrawlerProcess(dict(DEFAULT_SETTINGS, **(settings or {})))
+    for store_name in stores:
+        kwargs = dict(spider_kwargs)
+        if store_name:
+            kwargs['store'] = store_name
+        process.crawl(SPIDERS[name], **kwargs)
+    process.start()
+
+
+def main():
+    crawl(sys.argv[1] if len(sys.argv) > 1 else 'okd')
+
+
+if __name__ == '__main__':
+    main()
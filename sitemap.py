@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Sitemap-based discovery of the item URLs.
+
+Reads the site's sitemaps (from `robots.txt` or given explicitly),
+following the sitemap indexes. Each sitemap is streamed (gunzipped if
+needed) into a spooled temporary file (in memory up to `SPOOL_MEMORY_SIZE`,
+at most `MAX_SITEMAP_SIZE`, the protocol's limit), the response is closed,
+and the file is parsed with `iterparse`: neither the tree is kept in memory
+nor the connection held while the caller processes the URLs.
+Yields `dict(url, lastmod)` for the matching URLs; the sitemaps with an
+index `lastmod` older than `since` are not fetched at all. A sitemap that
+fails (HTTP error, too large, bad XML) is logged and skipped, the others
+are still read.
+
+Usage:
+
+    ./sitemap.py https://www.utkonos.ru '/item/'
+"""
+# pylint: disable=fixme
+
+import io
+import re
+import sys
+import gzip
+import logging
+import tempfile
+import functools
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+
+LOG = logging.getLogger(__name__)
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+GZIP_MAGIC = b'\x1f\x8b'
+MAX_SITEMAP_SIZE = 50 * 1024 * 1024  # uncompressed
+SPOOL_MEMORY_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class SitemapTooLarge(Exception):
+    """ The uncompressed sitemap is over `MAX_SITEMAP_SIZE` """
+
+
+def robots_sitemaps(fetch, site_url):
+    """ -> sitemap URLs listed in the site's robots.txt """
+    resp = fetch(urllib.parse.urljoin(site_url, '/robots.txt'))
+    return [
+        line.split(':', 1)[1].strip()
+        for line in resp.text.splitlines()
+        if line.lower().startswith('sitemap:')]
+
+
+def site_sitemaps(fetch, site_url):
+    """ -> sitemap URLs of the site's robots.txt, or the default `/sitemap.xml` """
+    try:
+        urls = robots_sitemaps(fetch, site_url)
+    except OSError as exc:  # including the `requests` errors
+        LOG.warning("No robots.txt of %s: %r", site_url, exc)
+        urls = None
+    return urls or [urllib.parse.urljoin(site_url, '/sitemap.xml')]
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Reader:
+    """ Minimal binary file object over a `read(size)` function, with the already read `head` """
+
+    def __init__(self, read, head=b''):
+        self._read = read
+        self.head = head
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            return data
+        return self._read(size if size is not None and size >= 0 else None) or b''
+
+
+def open_stream(resp):
+    """ streamed response -> binary file object of the (gunzipped) XML """
+    raw = getattr(resp, 'raw', None)
+    if raw is None or getattr(resp, '_content_consumed', False):
+        read = io.BytesIO(resp.content).read
+    else:
+        # Not `io.BufferedReader(raw)`: urllib3 closes the response at the end of the body.
+        read = functools.partial(raw.read, decode_content=True)  # the transfer encoding
+    head = read(len(GZIP_MAGIC)) or b''
+    fobj = _Reader(read, head)
+    if head == GZIP_MAGIC:  # a `.xml.gz` file
+        return gzip.GzipFile(fileobj=fobj)
+    return fobj
+
+
+def spool_sitemap(resp, max_size=MAX_SITEMAP_SIZE):
+    """ streamed response -> (uncompressed) XML in a temporary file object, at the start """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+    try:
+        source = open_stream(resp)
+        size = 0
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise SitemapTooLarge(getattr(resp, 'url', None), size)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def fetch_sitemap(fetch, url):
+    """ -> `spool_sitemap` of the fetched sitemap; the response is closed """
+    resp = fetch(url, stream=True)
+    try:
+        resp.raise_for_status()
+        return spool_sitemap(resp)
+    finally:
+        resp.close()
+
+
+def parse_sitemap(fobj):
+    """ XML file object -> iterable of ('url' or 'sitemap', loc, lastmod) """
+    context = ET.iterparse(fobj, events=('start', 'end'))
+    root = None
+    for event, elem in context:
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        kind = _local_name(elem.tag)
+        if kind not in ('url', 'sitemap'):
+            continue
+        loc = elem.findtext(SITEMAP_NS + 'loc') or elem.findtext('loc')
+        lastmod = elem.findtext(SITEMAP_NS + 'lastmod') or elem.findtext('lastmod')
+        if loc:
+            yield kind, loc.strip(), (lastmod or '').strip() or None
+        # Drop the processed entries.
+        elem.clear()
+        root.clear()
+
+
+def iter_sitemap_urls(fetch, sitemap_urls, url_re=None, since=None, max_depth=5):
+    """
+    :param fetch: `url, **kwargs -> response`, e.g. `WorkerBase.get`; called with `stream=True`.
+    :param url_re: regexp (string or compiled) the item URLs have to match.
+    :param since: ISO date(time) string; skip the entries with an older `lastmod`.
+    -> iterable of dict(url, lastmod)
+    """
+    if isinstance(url_re, str):
+        url_re = re.compile(url_re)
+    pending = [(url, 0) for url in sitemap_urls]
+    seen = set()
+    while pending:
+        sitemap_url, depth = pending.pop(0)
+        if sitemap_url in seen:
+            continue
+        seen.add(sitemap_url)
+        LOG.debug("Sitemap: %s", sitemap_url)
+        try:
+            spool = fetch_sitemap(fetch, sitemap_url)
+        except SitemapTooLarge as exc:
+            LOG.warning("Sitemap skipped, over %d bytes: %r", MAX_SITEMAP_SIZE, exc)
+            continue
+        except (OSError, EOFError) as exc:  # HTTP / connection errors, broken gzip
+            LOG.warning("Sitemap skipped, %s: %r", sitemap_url, exc)
+            continue
+        with spool:
+            try:
+                for kind, loc, lastmod in parse_sitemap(spool):
+                    if since and lastmod and lastmod < since:
+                        continue
+                    if kind == 'sitemap':
+                        if depth < max_depth:
+                            pending.append((loc, depth + 1))
+                        continue
+                    if url_re is not None and not url_re.search(loc):
+                        continue
+                    yield dict(url=loc, lastmod=lastmod)
+            except ET.ParseError as exc:
+                # The entries before the error are already yielded.
+                LOG.warning("Sitemap %s: bad XML, skipping the rest: %r", sitemap_url, exc)
+
+
+def main():
+    import requests
+    logging.basicConfig(level=logging.DEBUG)
+    site_url = sys.argv[1]
+    url_re = sys.argv[2] if len(sys.argv) > 2 else None
+    session = requests.Session()
+    sitemaps = site_sitemaps(session.get, site_url)
+    count = 0
+    for entry in iter_sitemap_urls(session.get, sitemaps, url_re=url_re):
+        count += 1
+        print(entry['url'], entry['lastmod'] or '')
+    LOG.info("URLs: %d", count)
+
+
+if __name__ == '__main__':
+    main()